@@ -0,0 +1,394 @@
+# benchmarks.py
+"""Микробенчмарки горячих путей бота.
+
+Запуск: python benchmarks.py [имя ...] — без аргументов выполняются все.
+Нужны зависимости из requirements.txt; настоящие токены и сеть не нужны,
+все файлы состояния создаются во временном каталоге.
+"""
+import io
+import json
+import asyncio
+import os
+import sys
+import queue
+import logging
+import logging.handlers
+import time
+import atexit
+import re
+import random
+import shutil
+import tempfile
+import tracemalloc
+import subprocess
+from types import SimpleNamespace
+
+BENCH_DIR = tempfile.mkdtemp(prefix="pozdravator-bench-")
+atexit.register(shutil.rmtree, BENCH_DIR, True)
+# main.py читает настройки при импорте, поэтому окружение готовим заранее
+os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ["GREETING_STORE_PATH"] = os.path.join(BENCH_DIR, "greetings.db")
+os.environ["PENDING_JOBS_PATH"] = os.path.join(BENCH_DIR, "pending_jobs.json")
+os.environ["ADMIN_NOTIFICATIONS_PATH"] = os.path.join(BENCH_DIR, "admin_notifications.json")
+os.environ["PAYMENTS_WAL_PATH"] = os.path.join(BENCH_DIR, "payments.wal")
+os.environ["TRACE_FILE_PATH"] = os.path.join(BENCH_DIR, "traces.jsonl")
+os.environ.pop("GOOGLE_CREDENTIALS_JSON", None)
+
+import main as bot
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+BENCHMARKS = {}
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+def measure(func, repeat):
+    """Время каждого из repeat вызовов, в секундах"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def percentile(samples, share):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+def report(name, samples):
+    print(f"  {name}: p50 {percentile(samples, 0.5) * 1e6:.1f} мкс, "
+          f"p99 {percentile(samples, 0.99) * 1e6:.1f} мкс, "
+          f"среднее {sum(samples) / len(samples) * 1e6:.1f} мкс")
+
+WORDS = (
+    "счастья радости любви тепла удачи вдохновения успехов здоровья мечты солнца улыбок друзей "
+    "семьи весны праздника поздравляю желаю пусть будет светлым каждый день приносит новые открытия"
+).split()
+
+def random_greeting(rng, words=60):
+    return " ".join(rng.choices(WORDS, k=words))
+
+def distinct_greeting(rng, words=40):
+    """Текст из случайных слов: в отличие от random_greeting, не считается повтором других"""
+    letters = "абвгдежзиклмнопрстуфхцчшэюя"
+    return " ".join("".join(rng.choices(letters, k=rng.randint(3, 9))) for _ in range(words))
+
+@benchmark
+def near_duplicates():
+    """Проверка трёх вариантов на повтор при полной памяти пользователя"""
+    rng = random.Random(1)
+    user_id = 1
+    bot.recent_variants.pop(user_id, None)
+    bot.remember_variants(user_id, [random_greeting(rng) for _ in range(bot.RECENT_VARIANTS_LIMIT)])
+    variants = [random_greeting(rng) for _ in range(3)]
+    report("filter_near_duplicates, 3 варианта", measure(lambda: bot.filter_near_duplicates(user_id, variants), 2000))
+    # Отдельно сравнение одной подписи с памятью, без построения подписи
+    signature = bot.variant_signature(variants[0])
+    seen = list(bot.recent_variants[user_id])
+    report("max_similarity, 1 подпись", measure(lambda: bot.max_similarity(signature, seen), 2000))
+
+STARTUP_PROBE = (
+    "import sys, time; started = time.perf_counter(); import main; "
+    "print(time.perf_counter() - started); "
+    "print(','.join(name for name in ('openai', 'gspread', 'google.oauth2') if name in sys.modules) or '-')"
+)
+FIRST_UPDATE_PROBE = "import asyncio, benchmarks; asyncio.run(benchmarks.first_update_probe())"
+
+class OfflineRequest(BaseRequest):
+    """Транспорт Bot API без сети: getMe и sendMessage отвечают готовыми объектами, остальное — True"""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        endpoint = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif endpoint == "sendMessage":
+            result = {"message_id": 2, "date": int(time.time()), "text": parameters.get("text", ""),
+                      "chat": {"id": parameters.get("chat_id", 1), "type": "private"}}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+async def first_update_probe():
+    """Путь run_polling без сети: initialize, post_init и первый апдейт /start с ответом пользователю.
+    Печатает секунды от начала импорта main.py до конца импорта, post_init и обработки апдейта"""
+    application = bot.build_application(
+        Application.builder().token(bot.TELEGRAM_TOKEN).request(OfflineRequest()).get_updates_request(OfflineRequest())
+    )
+    await application.initialize()
+    await application.post_init(application)
+    initialized = time.perf_counter()
+    update = Update.de_json({
+        "update_id": 1,
+        "message": {
+            "message_id": 1, "date": int(time.time()), "text": "/start",
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Bench", "language_code": "ru"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }, application.bot)
+    await application.process_update(update)
+    handled = time.perf_counter()
+    print(bot.IMPORTS_FINISHED - bot.STARTUP_STARTED, initialized - bot.STARTUP_STARTED, handled - bot.STARTUP_STARTED)
+    await application.shutdown()
+
+def run_probe(code, runs=5):
+    """Выполнить код в новом интерпретаторе runs раз; строки вывода каждого запуска"""
+    outputs = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        )
+        outputs.append(result.stdout.split())
+    return outputs
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+@benchmark
+def startup():
+    """Время импорта main.py и до первого апдейта в отдельном процессе; тяжёлые модули не должны загружаться"""
+    outputs = run_probe(STARTUP_PROBE)
+    durations = [float(duration) for duration, _ in outputs]
+    loaded = outputs[-1][1]
+    print(f"  импорт main: медиана {median(durations) * 1000:.0f} мс, мин {min(durations) * 1000:.0f} мс")
+    print(f"  тяжёлые модули после импорта: {'не загружены' if loaded == '-' else loaded}")
+
+    stages = list(zip(*[map(float, output) for output in run_probe(FIRST_UPDATE_PROBE)]))
+    for name, values in zip(("конец импорта", "post_init", "первый апдейт обработан"), stages):
+        print(f"  {name}: медиана {median(values) * 1000:.0f} мс от начала импорта main.py")
+
+def bench_logger(name, handler):
+    """Отдельный логгер, чтобы вывод бенчмарка не смешивался с логом бота"""
+    log = logging.getLogger(f"bench.{name}")
+    log.handlers[:] = [handler]
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    return log
+
+def measure_logging(name, write, repeat, log_queue=None, handler=None):
+    """Время вызова для кода бота и процессорное время всех потоков на запись,
+    включая форматирование и вывод в потоке слушателя"""
+    listener = logging.handlers.QueueListener(log_queue, handler) if log_queue is not None else None
+    if listener:
+        listener.start()
+    cpu_started = time.process_time()
+    samples = measure(write, repeat)
+    if listener:
+        # stop() дожидается, пока слушатель разберёт очередь до конца
+        listener.stop()
+    cpu = (time.process_time() - cpu_started) / repeat
+    report(name, samples)
+    print(f"    вместе со слушателем: {cpu * 1e6:.1f} мкс процессорного времени на запись")
+
+@benchmark
+def logging_path():
+    """Стоимость записи в лог: прежний синхронный StreamHandler против очереди со слушателем"""
+    row = ["2024-01-01 12:00:00", 123456789, "ivan", "День рождения", "Коллеге", "Дружеский", "Да", "Иван"]
+    stream_handler = logging.StreamHandler(io.StringIO())
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    sync_logger = bench_logger("sync", stream_handler)
+    measure_logging("f-строка, синхронный вывод в память",
+                    lambda: sync_logger.info(f"📊 Записано в Поздравления: {row}"), 20000)
+    file_handler = logging.FileHandler(os.path.join(BENCH_DIR, "sync.log"), encoding="utf-8")
+    file_handler.setFormatter(stream_handler.formatter)
+    file_logger = bench_logger("file", file_handler)
+    measure_logging("f-строка, синхронный вывод в файл",
+                    lambda: file_logger.info(f"📊 Записано в Поздравления: {row}"), 20000)
+    file_handler.close()
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = bot.DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(bot.SamplingFilter())
+    json_handler = logging.StreamHandler(io.StringIO())
+    json_handler.setFormatter(bot.JsonFormatter())
+    queued_logger = bench_logger("queued", queue_handler)
+    extra = {"event": "sheets_write", "stage": "sheets", "user_id": 123456789}
+    write = lambda: queued_logger.info("📊 Записано в %s: %s", "Поздравления", row, extra=extra)
+    measure_logging("ленивый %s с extra, очередь", write, 20000, log_queue, json_handler)
+    saved_rates = dict(bot.LOG_SAMPLE_RATES)
+    bot.LOG_SAMPLE_RATES["sheets_write"] = 0.1
+    measure_logging("то же, LOG_SAMPLE_RATES=sheets_write=0.1", write, 20000, log_queue, json_handler)
+    bot.LOG_SAMPLE_RATES.clear()
+    bot.LOG_SAMPLE_RATES.update(saved_rates)
+
+class StubCompletions:
+    """Ответ OpenAI без сети: три варианта сразу после одного переключения цикла событий"""
+    content = "\n\n".join(f"{index}. Дорогой друг! {distinct_greeting(random.Random(index))}" for index in (1, 2, 3))
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(0)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.content))])
+
+async def traced_generations(params, repeat, first_user_id):
+    """Корневой спан generation и настоящий produce_variants, как в generate_message;
+    у каждого вызова свой пользователь, чтобы хранилище и фильтр повторов вели себя как у новых"""
+    samples = []
+    for user_id in range(first_user_id, first_user_id + repeat):
+        started = time.perf_counter()
+        with bot.trace_span("generation", user_id=user_id):
+            await bot.produce_variants(user_id, params)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def replay_trace(spans):
+    """Повторить дерево спанов трассы с теми же именами и атрибутами, без работы внутри"""
+    children = {}
+    for span in spans:
+        children.setdefault(span.parent_id, []).append(span)
+
+    def enter(span):
+        with bot.trace_span(span.name, **span.attributes):
+            for child in children.get(span.span_id, ()):
+                enter(child)
+
+    enter(children[""][0])
+
+def fastest_round(params, rounds, first_user_id):
+    """Минимум по сериям среднего времени генерации: на шумной машине устойчивее среднего по всем вызовам"""
+    best = None
+    for round_index in range(rounds):
+        samples = asyncio.run(traced_generations(params, 100, first_user_id + round_index * 100))
+        mean = sum(samples) / len(samples)
+        best = mean if best is None else min(best, mean)
+    return best
+
+@benchmark
+def tracing():
+    """Накладные расходы трассировки на produce_variants: ответ из хранилища и ответ OpenAI-заглушки"""
+    locale = bot.CATALOG.locale()
+    subcategory_key = next(iter(locale.occasions))
+    rng = random.Random(1)
+    bot.save_greetings(0, subcategory_key, "standard", False, [distinct_greeting(rng) for _ in range(300)])
+    paths = {
+        # Хранилище: спаны generation и store_lookup
+        "хранилище": {"subcategory_key": subcategory_key, "style": "standard", "emojis": False, "name": None},
+        # С мужским именем, которого нет в хранилище: store_lookup, prompt, openai, parse; ответ не сохраняется
+        "OpenAI-заглушка": {"subcategory_key": subcategory_key, "style": "formal", "emojis": True, "name": "Иван"},
+    }
+    bot.OPENAI_CLIENT = SimpleNamespace(chat=SimpleNamespace(completions=StubCompletions()))
+    saved = bot.TRACE_EXPORT, bot.TRACE_SAMPLE_RATE, bot.TRACE_EXPORT_INTERVAL
+    # Поток экспорта не должен забирать трассы, которые бенчмарк выгружает сам
+    bot.TRACE_EXPORT_INTERVAL = 3600
+    # Лог бота пишет в stderr из потока слушателя; на время замера его отключаем для всех режимов
+    logging.disable(logging.INFO)
+    first_user_id = 1000
+    for path, params in paths.items():
+        params = dict(params, main_category="bench", locale=locale.code)
+        bot.TRACE_EXPORT = ""
+        baseline = fastest_round(params, 15, first_user_id)
+        first_user_id += 1500
+
+        # Трассы настоящего пути: по ним же считаем и цену спанов, и цену экспорта
+        bot.TRACE_EXPORT, bot.TRACE_SAMPLE_RATE = "file", 1.0
+        asyncio.run(traced_generations(params, 100, first_user_id))
+        first_user_id += 100
+        traces = []
+        while not bot.TRACE_EXPORT_QUEUE.empty():
+            traces.append(bot.TRACE_EXPORT_QUEUE.get_nowait())
+        # Спаны создаются всегда, а при TRACE_SAMPLE_RATE=0 быстрые трассы не экспортируются.
+        # Разница с путём целиком тонет в шуме, поэтому та же форма трассы повторяется отдельно
+        bot.TRACE_SAMPLE_RATE = 0.0
+        spans_cost = min(measure(lambda: replay_trace(traces[0]), 2000))
+        # Экспорт: сериализация и запись пачки в потоке экспорта, который держит GIL
+        export_cost = min(measure(lambda: bot.write_traces(traces), 20)) / len(traces)
+
+        print(f"  {path}: генерация без трассировки {baseline * 1e6:.0f} мкс, {len(traces[0])} спанов в трассе, "
+              f"спаны {spans_cost * 1e6:.1f} мкс, экспорт {export_cost * 1e6:.1f} мкс на трассу")
+        for rate in (0.05, 1.0):
+            overhead = spans_cost + rate * export_cost
+            print(f"    TRACE_SAMPLE_RATE={rate}: {overhead * 1e6:.1f} мкс, {overhead / baseline:.1%} от генерации (цель < 1%)")
+    logging.disable(logging.NOTSET)
+    bot.TRACE_EXPORT, bot.TRACE_SAMPLE_RATE, bot.TRACE_EXPORT_INTERVAL = saved
+    bot.OPENAI_CLIENT = None
+
+def run_coroutine(coroutine):
+    """Выполнить корутину без цикла событий: обработчики бенчмарка не ждут ввода-вывода"""
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("корутина бенчмарка не должна приостанавливаться")
+
+@benchmark
+def callbacks():
+    """Разбор нажатия кнопки: цепочка регулярных выражений против словаря callback_router"""
+    async def handler(update, context, value=None):
+        return value
+
+    for count in (10, 100, 1000):
+        actions = [f"a{index}" for index in range(count)]
+        # Худший случай прежней схемы: подходит только последний шаблон из цепочки
+        patterns = [re.compile(rf"^{action}_(.+)$") for action in actions]
+        legacy_data = f"{actions[-1]}_value"
+
+        def legacy_dispatch():
+            for pattern in patterns:
+                match = pattern.match(legacy_data)
+                if match:
+                    return run_coroutine(handler(None, None, match.group(1)))
+
+        route = bot.callback_router(dict.fromkeys(actions, handler))
+        update = SimpleNamespace(callback_query=SimpleNamespace(data=bot.encode_callback(actions[-1], "value")))
+        report(f"{count} действий, цепочка шаблонов", measure(legacy_dispatch, 2000))
+        report(f"{count} действий, callback_router", measure(lambda: run_coroutine(route(update, None)), 2000))
+
+INLINE_VARIANTS_PER_SUBCATEGORY = 200
+
+@benchmark
+def inline():
+    """Размер инлайн-индекса и время поиска без кэша на синтетическом хранилище"""
+    rng = random.Random(1)
+    catalog = bot.CATALOG
+    for code, locale in catalog.locales.items():
+        prefix = "" if code == catalog.default_locale else f"{code}:"
+        for key in locale.occasions:
+            variants = [random_greeting(rng) for _ in range(INLINE_VARIANTS_PER_SUBCATEGORY)]
+            bot.save_greetings(0, f"{prefix}{key}", "bench", True, variants)
+    tracemalloc.start()
+    started = time.perf_counter()
+    bot.INLINE_INDEXES = bot.build_inline_indexes(catalog)
+    build_seconds = time.perf_counter() - started
+    index_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    indexes = bot.INLINE_INDEXES.values()
+    print(f"  индекс: {sum(len(index.docs) for index in indexes)} вариантов, "
+          f"{sum(len(index.postings) for index in indexes)} ключей, "
+          f"{sum(len(docs) for index in indexes for docs in index.postings.values())} ссылок, "
+          f"{index_bytes / 2 ** 20:.1f} МБ, сборка {build_seconds:.2f} с")
+    for code, locale in catalog.locales.items():
+        index = bot.INLINE_INDEXES[code]
+        labels = list(locale.subcategory_labels.values())
+        queries = [f"{rng.choice(labels)} {rng.choice(WORDS)}" for _ in range(1000)]
+        queries = iter(queries * 2)
+
+        def search():
+            index.cache.clear()
+            bot.inline_results(locale, next(queries))
+
+        samples = measure(search, 2000)
+        report(f"поиск без кэша, {code}", samples)
+        print(f"  p99 {percentile(samples, 0.99) * 1000:.2f} мс (цель < 10 мс)")
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        sys.exit(f"Неизвестные бенчмарки: {', '.join(unknown)}; есть: {', '.join(BENCHMARKS)}")
+    for name in names:
+        print(f"{name}: {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name]()
+
+if __name__ == '__main__':
+    main()
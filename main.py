@@ -1,112 +1,342 @@
 # main.py
+import time
+STARTUP_STARTED = time.perf_counter()
+
 import os
+import sys
 import logging
+import logging.handlers
+import queue
+import atexit
+import threading
+import contextvars
+import urllib.request
 import asyncio
 import json
-import tempfile
+import re
+import zlib
+import operator
+import signal
+import sqlite3
+import random
+import hashlib
+import heapq
+import importlib
+from collections import deque, defaultdict
+from types import SimpleNamespace
 from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
+from zoneinfo import ZoneInfo
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InlineQueryResultsButton,
+    InputTextMessageContent,
+    LabeledPrice,
+)
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     ConversationHandler,
+    InlineQueryHandler,
     MessageHandler,
     PreCheckoutQueryHandler,
+    TypeHandler,
     filters,
     ContextTypes,
 )
-from telegram.error import Conflict
-import openai
+from telegram.error import BadRequest, Conflict, Forbidden, RetryAfter
+
+# openai, gspread и google-auth импортируются лениво: они нужны только после старта
+IMPORTS_FINISHED = time.perf_counter()
 
 # --- НАЧАЛО: Google Sheets ---
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+ANALYTICS_ENABLED = bool(os.getenv("GOOGLE_CREDENTIALS_JSON") and os.getenv("GOOGLE_SHEET_ID"))
+SHEETS_SCOPES = [
+    'https://spreadsheets.google.com/feeds',
+    'https://www.googleapis.com/auth/drive'
+]
+WORKSHEET_NAMES = ("Users", "Generations", "Donations", "Feedback", "RateLimits")
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)  # Обновляем токен заранее, до истечения
+TOKEN_CHECK_INTERVAL = 60
+SHEETS_MAX_BACKOFF = 300
 
 def init_google_sheets():
     """Инициализация подключения к Google Sheets"""
     try:
+        import gspread
+        from google.oauth2.service_account import Credentials
+        
         creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON")
         sheet_id = os.getenv("GOOGLE_SHEET_ID")
         
         if not creds_json or not sheet_id:
             logger.warning("⚠️ Google Sheets не настроены. Аналитика отключена.")
-            return None, None
-        
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as temp_file:
-            temp_file.write(creds_json)
-            temp_file_path = temp_file.name
+            return None, None, None
         
-        scope = [
-            'https://spreadsheets.google.com/feeds',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        
-        creds = ServiceAccountCredentials.from_json_keyfile_name(temp_file_path, scope)
+        # Ключ разбираем в памяти, без временного файла на диске
+        creds = Credentials.from_service_account_info(json.loads(creds_json), scopes=SHEETS_SCOPES)
+        # Клиент gspread держит одну keep-alive сессию на все запросы
         client = gspread.authorize(creds)
         
-        os.unlink(temp_file_path)
-        
         sheet = client.open_by_key(sheet_id)
         
         logger.info("✅ Google Sheets успешно подключены!")
-        return sheet, sheet_id
+        return sheet, sheet_id, creds
         
     except Exception as e:
         logger.error(f"❌ Ошибка подключения к Google Sheets: {e}")
-        return None, None
+        return None, None, None
+
+def load_worksheets(sheet):
+    """Найти все листы одним запросом и загрузить индекс строк пользователей"""
+    worksheets = {worksheet.title: worksheet for worksheet in sheet.worksheets()}
+    missing = [name for name in WORKSHEET_NAMES if name not in worksheets]
+    if missing:
+        logger.warning(f"⚠️ В таблице нет листов: {', '.join(missing)}")
+    
+    user_rows = {}
+    if "Users" in worksheets:
+        # Пропускаем первую строку (заголовок); номер строки = индекс + 2
+        for index, row in enumerate(worksheets["Users"].get_values("A:F")[1:]):
+            if row and row[0]:
+                count = row[5] if len(row) > 5 else ""
+                user_rows[row[0]] = [index + 2, int(count or 0)]
+    return worksheets, user_rows
 
 GOOGLE_SHEET = None
 GOOGLE_SHEET_ID = None
+SHEETS_CREDENTIALS = None
+WORKSHEETS = {}   # Имя листа → Worksheet, чтобы не запрашивать метаданные перед каждой записью
+USER_ROWS = {}    # user_id (строкой) → [номер строки в Users, счётчик генераций]
+
+# --- Буфер аналитики ---
+# Записи не выполняются прямо в обработчиках: они копятся в очереди и пишутся фоновой задачей,
+# а при остановке бота дописываются или сохраняются на диск до следующего запуска
+ANALYTICS_QUEUE = deque()
+ANALYTICS_QUEUE_LIMIT = 10000  # При долгой недоступности Sheets старые записи вытесняются, кроме донатов
+ANALYTICS_MAX_ATTEMPTS = 5
+ANALYTICS_RETRY_DELAY = 5
+ANALYTICS_WAKEUP = None
+ANALYTICS_TASK = None
+ANALYTICS_DRAINING = False
+
+def user_snapshot(user):
+    """Данные пользователя, нужные аналитике, в сериализуемом виде"""
+    return {
+        "id": user.id,
+        "username": user.username,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+    }
 
-def log_to_sheets(worksheet_name, data):
-    """Записать данные в указанный лист Google Sheets"""
-    try:
-        if not GOOGLE_SHEET:
-            return
-        
-        worksheet = GOOGLE_SHEET.worksheet(worksheet_name)
-        worksheet.append_row(data)
-        logger.info(f"📊 Записано в {worksheet_name}: {data}")
+def enqueue_analytics(op):
+    """Поставить запись аналитики в очередь"""
+    if not ANALYTICS_ENABLED:
+        return
+    if len(ANALYTICS_QUEUE) >= ANALYTICS_QUEUE_LIMIT:
+        # Донаты (записи с charge_id) не вытесняются: журнал платежей ждёт их записи в таблицу
+        for index, queued in enumerate(ANALYTICS_QUEUE):
+            if "charge_id" not in queued:
+                del ANALYTICS_QUEUE[index]
+                inc_metric("analytics_evicted")
+                break
+    ANALYTICS_QUEUE.append(op)
+    if ANALYTICS_WAKEUP:
+        ANALYTICS_WAKEUP.set()
+
+def append_row(worksheet_name, data):
+    WORKSHEETS[worksheet_name].append_row(data)
+    logger.info("📊 Записано в %s", worksheet_name, extra={"event": "sheets_write", "stage": "analytics"})
+    logger.debug("📊 Строка для %s: %s", worksheet_name, data)
+
+def touch_user_row(user, seen_at):
+    worksheet = WORKSHEETS["Users"]
+    user_key = str(user["id"])
+    
+    if user_key in USER_ROWS:
+        row_num, current_count = USER_ROWS[user_key]
         
-    except Exception as e:
-        logger.error(f"❌ Ошибка записи в Google Sheets ({worksheet_name}): {e}")
+        # Обновляем последний визит и счётчик генераций одним запросом
+        worksheet.update(values=[[seen_at, current_count + 1]], range_name=f"E{row_num}:F{row_num}")
+        USER_ROWS[user_key][1] = current_count + 1
+        logger.info("👤 Обновлён пользователь: %s (@%s)", user["id"], user["username"],
+                    extra={"event": "user_event", "stage": "analytics", "user_id": user["id"]})
+    else:
+        # Добавляем нового пользователя
+        data = [
+            user["id"],
+            user["username"] or "без username",
+            f"{user['first_name'] or ''} {user['last_name'] or ''}".strip(),
+            seen_at,
+            seen_at,
+            0  # Счётчик генераций
+        ]
+        response = worksheet.append_row(data)
+        # Номер новой строки берём из ответа API, например "Users!A42:F42"
+        match = re.search(r"![A-Z]+(\d+)", response.get("updates", {}).get("updatedRange", ""))
+        if match:
+            USER_ROWS[user_key] = [int(match.group(1)), 0]
+        logger.info("👤 Новый пользователь: %s (@%s)", user["id"], user["username"],
+                    extra={"event": "user_event", "stage": "analytics", "user_id": user["id"]})
+
+def count_generation_row(user):
+    user_key = str(user["id"])
+    
+    if user_key in USER_ROWS:
+        row_num, current_count = USER_ROWS[user_key]
+        WORKSHEETS["Users"].update_cell(row_num, 6, current_count + 1)
+        USER_ROWS[user_key][1] = current_count + 1
+        logger.info("✅ Счётчик генераций обновлён: %s → %s", user["id"], current_count + 1,
+                    extra={"event": "user_event", "stage": "analytics", "user_id": user["id"]})
+    else:
+        logger.warning("⚠️ Пользователь %s не найден в Users для обновления счётчика", user["id"],
+                       extra={"event": "user_event", "stage": "analytics", "user_id": user["id"]})
 
-def log_user(user):
-    """Записать/обновить информацию о пользователе"""
+def apply_analytics_op(op):
+    """Выполнить одну запись в Google Sheets; True, если запись сделана или повторять её бессмысленно"""
     try:
-        if not GOOGLE_SHEET:
-            return
-        
-        worksheet = GOOGLE_SHEET.worksheet("Users")
-        
-        # Получаем все user_id из столбца A (пропускаем заголовок)
-        user_ids = worksheet.col_values(1)[1:]  # Пропускаем первую строку (заголовок)
-        
-        # Ищем индекс пользователя (добавляем 2: 1 для индексации с 1, 1 для заголовка)
-        if str(user.id) in user_ids:
-            row_num = user_ids.index(str(user.id)) + 2
-            
-            # Обновляем последний визит и счётчик генераций
-            current_count = int(worksheet.cell(row_num, 6).value or 0)
-            worksheet.update_cell(row_num, 5, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-            worksheet.update_cell(row_num, 6, current_count + 1)
-            logger.info(f"👤 Обновлён пользователь: {user.id} (@{user.username})")
+        if op["op"] == "append":
+            append_row(op["worksheet"], op["row"])
+        elif op["op"] == "touch_user":
+            touch_user_row(op["user"], op["seen_at"])
+        elif op["op"] == "count_generation":
+            count_generation_row(op["user"])
         else:
-            # Добавляем нового пользователя
-            data = [
-                user.id,
-                user.username or "без username",
-                f"{user.first_name or ''} {user.last_name or ''}".strip(),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                0  # Счётчик генераций
-            ]
-            worksheet.append_row(data)
-            logger.info(f"👤 Новый пользователь: {user.id} (@{user.username})")
-            
+            logger.error(f"❌ Неизвестная операция аналитики: {op['op']}")
+        return True
     except Exception as e:
-        logger.error(f"❌ Ошибка логирования пользователя: {e}")
+        if op["op"] == "append":
+            logger.error(f"❌ Ошибка записи в Google Sheets ({op['worksheet']}): {e}")
+        elif op["op"] == "touch_user":
+            logger.error(f"❌ Ошибка логирования пользователя: {e}")
+        else:
+            logger.error(f"❌ Ошибка обновления счётчика генераций: {e}")
+        return False
+
+def open_google_sheets():
+    sheet, sheet_id, creds = init_google_sheets()
+    if not sheet:
+        return sheet, sheet_id, creds, {}, {}
+    return (sheet, sheet_id, creds) + load_worksheets(sheet)
+
+async def connect_google_sheets():
+    """Подключиться к Google Sheets в отдельном потоке, не задерживая запуск бота"""
+    global GOOGLE_SHEET, GOOGLE_SHEET_ID, SHEETS_CREDENTIALS, WORKSHEETS, USER_ROWS
+    started = time.perf_counter()
+    try:
+        connection = await asyncio.to_thread(open_google_sheets)
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки листов Google Sheets: {e}")
+        connection = (None, None, None, {}, {})
+    GOOGLE_SHEET, GOOGLE_SHEET_ID, SHEETS_CREDENTIALS, WORKSHEETS, USER_ROWS = connection
+    if GOOGLE_SHEET:
+        logger.info(f"⏱ Google Sheets подключены за {time.perf_counter() - started:.2f} с, пользователей: {len(USER_ROWS)}")
+
+def refresh_sheets_token():
+    from google.auth.transport.requests import Request
+    SHEETS_CREDENTIALS.refresh(Request())
+    logger.info("🔑 Токен Google обновлён заранее")
+
+async def sheets_token_refresher():
+    """Обновлять токен OAuth до истечения, чтобы первая запись после него не ждала обновления"""
+    while True:
+        await asyncio.sleep(TOKEN_CHECK_INTERVAL)
+        creds = SHEETS_CREDENTIALS
+        if not creds or not creds.expiry:
+            continue
+        # expiry в google-auth хранится как naive UTC
+        if creds.expiry - datetime.utcnow() > TOKEN_REFRESH_MARGIN:
+            continue
+        try:
+            await asyncio.to_thread(refresh_sheets_token)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обновления токена Google: {e}")
+
+async def analytics_writer():
+    """Фоновая запись очереди аналитики в Google Sheets"""
+    if not ANALYTICS_ENABLED:
+        return
+    # Пока идёт подключение, записи просто копятся в очереди
+    await connect_google_sheets()
+    refresher = asyncio.create_task(sheets_token_refresher())
+    failures = 0
+    try:
+        while True:
+            if not ANALYTICS_QUEUE:
+                if ANALYTICS_DRAINING:
+                    return
+                ANALYTICS_WAKEUP.clear()
+                await ANALYTICS_WAKEUP.wait()
+                continue
+            
+            op = ANALYTICS_QUEUE[0]
+            if GOOGLE_SHEET and await asyncio.to_thread(apply_analytics_op, op):
+                # Пока шла запись, голову очереди могло вытеснить
+                if ANALYTICS_QUEUE and ANALYTICS_QUEUE[0] is op:
+                    ANALYTICS_QUEUE.popleft()
+                failures = 0
+                if "charge_id" in op:
+                    await mark_payment_logged(op["charge_id"])
+                continue
+            
+            # При остановке не ждём: оставшиеся записи будут сохранены на диск
+            if ANALYTICS_DRAINING:
+                return
+            if GOOGLE_SHEET:
+                op["attempts"] = op.get("attempts", 0) + 1
+                if op["attempts"] >= ANALYTICS_MAX_ATTEMPTS and ANALYTICS_QUEUE and ANALYTICS_QUEUE[0] is op:
+                    ANALYTICS_QUEUE.popleft()
+                    if "charge_id" in op:
+                        # Донат не отбрасываем: переносим в конец, чтобы он не задерживал остальные записи
+                        logger.error(f"❌ Донат {op['charge_id']} не записан после {op['attempts']} попыток, повторю позже")
+                        op["attempts"] = 0
+                        ANALYTICS_QUEUE.append(op)
+                    else:
+                        logger.error(f"❌ Запись аналитики отброшена после {op['attempts']} попыток: {op}")
+            
+            # Переподключаемся с экспоненциальной задержкой: новая сессия, токен и листы
+            failures += 1
+            delay = min(ANALYTICS_RETRY_DELAY * 2 ** (failures - 1), SHEETS_MAX_BACKOFF)
+            logger.warning(f"⚠️ Переподключение к Google Sheets через {delay} с")
+            await asyncio.sleep(delay)
+            await connect_google_sheets()
+    finally:
+        refresher.cancel()
+
+def start_analytics_writer():
+    global ANALYTICS_WAKEUP, ANALYTICS_TASK
+    ANALYTICS_WAKEUP = asyncio.Event()
+    if ANALYTICS_QUEUE:
+        ANALYTICS_WAKEUP.set()
+    ANALYTICS_TASK = asyncio.create_task(analytics_writer())
+
+async def flush_analytics(timeout):
+    """Дописать очередь аналитики, ожидая не дольше timeout секунд"""
+    global ANALYTICS_DRAINING
+    ANALYTICS_DRAINING = True
+    if not ANALYTICS_TASK:
+        return
+    ANALYTICS_WAKEUP.set()
+    await asyncio.wait({ANALYTICS_TASK}, timeout=timeout)
+    if not ANALYTICS_TASK.done():
+        ANALYTICS_TASK.cancel()
+    if ANALYTICS_QUEUE:
+        logger.warning(f"⚠️ Не записано в Google Sheets: {len(ANALYTICS_QUEUE)}, сохраню до следующего запуска")
+
+def log_to_sheets(worksheet_name, data):
+    """Записать данные в указанный лист Google Sheets"""
+    enqueue_analytics({"op": "append", "worksheet": worksheet_name, "row": data})
+
+def log_user(user):
+    """Записать/обновить информацию о пользователе"""
+    enqueue_analytics({
+        "op": "touch_user",
+        "user": user_snapshot(user),
+        "seen_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    })
 
 def log_generation(user, category, subcategory, style, emojis, name_provided, success):
     """Записать генерацию поздравления"""
@@ -124,29 +354,10 @@ def log_generation(user, category, subcategory, style, emojis, name_provided, su
     log_to_sheets("Generations", data)
     
     # Обновляем счётчик генераций пользователя
-    try:
-        if not GOOGLE_SHEET:
-            return
-        
-        worksheet = GOOGLE_SHEET.worksheet("Users")
-        
-        # Получаем все user_id из столбца A (пропускаем заголовок)
-        user_ids = worksheet.col_values(1)[1:]
-        
-        # Ищем индекс пользователя
-        if str(user.id) in user_ids:
-            row_num = user_ids.index(str(user.id)) + 2
-            current_count = int(worksheet.cell(row_num, 6).value or 0)
-            worksheet.update_cell(row_num, 6, current_count + 1)
-            logger.info(f"✅ Счётчик генераций обновлён: {user.id} → {current_count + 1}")
-        else:
-            logger.warning(f"⚠️ Пользователь {user.id} не найден в Users для обновления счётчика")
-            
-    except Exception as e:
-        logger.error(f"❌ Ошибка обновления счётчика генераций: {e}")
+    enqueue_analytics({"op": "count_generation", "user": user_snapshot(user)})
 
-def log_donation(user, amount, payload):
-    """Записать донат"""
+def log_donation(user, amount, payload, charge_id):
+    """Записать донат; после записи в таблицу платёж отмечается в журнале как обработанный"""
     data = [
         datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         user.id,
@@ -154,7 +365,7 @@ def log_donation(user, amount, payload):
         amount,
         payload
     ]
-    log_to_sheets("Donations", data)
+    enqueue_analytics({"op": "append", "worksheet": "Donations", "row": data, "charge_id": charge_id})
 
 def log_feedback(user, message):
     """Записать обратную связь"""
@@ -182,6 +393,1078 @@ def log_rate_limit(user, seconds_left):
 request_times = {}
 # --- КОНЕЦ: Лимит запросов ---
 
+# --- НАЧАЛО: Метрики ---
+METRICS = defaultdict(float)
+METRICS_STARTED = time.monotonic()
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", "300"))
+
+def inc_metric(name, value=1):
+    METRICS[name] += value
+
+def observe_metric(name, value):
+    """Учесть наблюдение: количество, сумма и максимум"""
+    METRICS[f"{name}_count"] += 1
+    METRICS[f"{name}_sum"] += value
+    METRICS[f"{name}_max"] = max(METRICS[f"{name}_max"], value)
+
+def format_metrics():
+    """Текстовая сводка метрик (для /metrics и периодического лога)"""
+    uptime = time.monotonic() - METRICS_STARTED
+    lines = [f"uptime_seconds {uptime:.0f}"]
+    for name in sorted(METRICS):
+        lines.append(f"{name} {METRICS[name]:.6g}")
+    if uptime > 0:
+        lines.append(f"messages_sent_per_second {METRICS['messages_sent'] / uptime:.3f}")
+    return "\n".join(lines)
+
+async def metrics_logger():
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        logger.info(f"📈 Метрики:\n{format_metrics()}")
+# --- КОНЕЦ: Метрики ---
+
+# --- НАЧАЛО: Трассировка ---
+# Спан на каждый этап обработки; контекст передаётся через contextvars, поэтому спаны из задач asyncio
+# попадают в трассу родителя. TRACE_EXPORT: "" (выключено), "file" (JSON-строки в TRACE_FILE_PATH)
+# или "otlp" (OTLP/HTTP JSON на TRACE_OTLP_ENDPOINT). Tail sampling: трасса целиком сохраняется,
+# если она медленнее TRACE_SLOW_MS, иначе — с вероятностью TRACE_SAMPLE_RATE.
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "")
+TRACE_FILE_PATH = os.getenv("TRACE_FILE_PATH", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.05"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "5000"))
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "1"))  # сек между выгрузками пачки трасс
+TRACE_SERVICE_NAME = "pozdravator-bot"
+
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+TRACE_EXPORT_QUEUE = queue.SimpleQueue()
+TRACE_EXPORT_STOP = threading.Event()
+TRACE_EXPORTER = None
+
+class Span:
+    """Этап обработки запроса; используется как контекстный менеджер"""
+    __slots__ = ("name", "attributes", "trace_id", "span_id", "parent_id", "spans", "start_ns", "end_ns", "token")
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        parent = CURRENT_SPAN.get()
+        if parent is None:
+            self.trace_id = os.urandom(16).hex()
+            self.parent_id = ""
+            self.spans = []
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            self.spans = parent.spans
+        self.span_id = os.urandom(8).hex()
+        self.token = CURRENT_SPAN.set(self)
+        self.start_ns = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        CURRENT_SPAN.reset(self.token)
+        self.spans.append(self)
+        if not self.parent_id:
+            finish_trace(self)
+        return False
+
+class NoopSpan:
+    """Заглушка, когда трассировка выключена"""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NOOP_SPAN = NoopSpan()
+
+def set_span_attribute(key, value):
+    """Добавить атрибут к текущему спану, если трассировка включена"""
+    span = CURRENT_SPAN.get()
+    if span is not None:
+        span.set_attribute(key, value)
+
+def trace_span(name, **attributes):
+    if not TRACE_EXPORT:
+        return NOOP_SPAN
+    return Span(name, attributes)
+
+def finish_trace(root):
+    """Tail sampling по длительности корневого спана и постановка трассы в очередь экспорта"""
+    duration_ms = (root.end_ns - root.start_ns) / 1e6
+    if duration_ms < TRACE_SLOW_MS and random.random() >= TRACE_SAMPLE_RATE:
+        return
+    inc_metric("traces_exported")
+    TRACE_EXPORT_QUEUE.put(root.spans)
+    start_trace_exporter()
+
+def otlp_payload(spans):
+    """Трасса в формате OTLP/HTTP JSON"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+        "scopeSpans": [{
+            "scope": {"name": TRACE_SERVICE_NAME},
+            "spans": [{
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                "parentSpanId": span.parent_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns),
+                "attributes": [{"key": key, "value": {"stringValue": str(value)}} for key, value in span.attributes.items()],
+            } for span in spans],
+        }],
+    }]}
+
+def write_traces(traces):
+    """Одна запись на пачку: строка на трассу в файл или один OTLP-запрос со всеми спанами"""
+    if TRACE_EXPORT == "otlp":
+        payload = json.dumps(otlp_payload([span for spans in traces for span in spans]), ensure_ascii=False)
+        request = urllib.request.Request(
+            TRACE_OTLP_ENDPOINT, data=payload.encode(), headers={"Content-Type": "application/json"}
+        )
+        urllib.request.urlopen(request, timeout=5).close()
+    else:
+        lines = "".join(json.dumps(otlp_payload(spans), ensure_ascii=False) + "\n" for spans in traces)
+        with open(TRACE_FILE_PATH, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+def export_traces():
+    """Поток экспорта: раз в TRACE_EXPORT_INTERVAL забирает накопленные трассы пачкой.
+    Пробуждение на каждую трассу отнимало GIL у цикла событий чаще, чем сама сериализация"""
+    while True:
+        stopping = TRACE_EXPORT_STOP.wait(TRACE_EXPORT_INTERVAL)
+        traces = []
+        while True:
+            try:
+                traces.append(TRACE_EXPORT_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        if traces:
+            try:
+                write_traces(traces)
+            except Exception as e:
+                logger.error(f"❌ Ошибка экспорта трасс ({len(traces)}): {e}")
+        if stopping:
+            return
+
+def stop_trace_exporter():
+    TRACE_EXPORT_STOP.set()
+    TRACE_EXPORTER.join(timeout=5)
+
+def start_trace_exporter():
+    global TRACE_EXPORTER
+    if TRACE_EXPORTER is None:
+        TRACE_EXPORTER = threading.Thread(target=export_traces, name="trace-exporter", daemon=True)
+        TRACE_EXPORTER.start()
+        atexit.register(stop_trace_exporter)
+# --- КОНЕЦ: Трассировка ---
+
+# --- НАЧАЛО: Отправка сообщений ---
+# Лимиты Telegram: около 1 сообщения в секунду в один чат и около 30 в секунду всего
+PRIORITY_INTERACTIVE = 0  # Ответы пользователю в текущем диалоге
+PRIORITY_SCHEDULED = 1    # Запланированные поздравления
+PRIORITY_ADMIN = 2        # Уведомления администратору
+PRIORITY_LEVELS = 3
+CHAT_SEND_RATE = 1.0
+# Полный ответ на генерацию — до 6 сообщений (уведомления, 3 варианта, меню): он должен уходить
+# без ожидания, иначе пауза в acquire задерживает обработку апдейтов всех пользователей
+CHAT_SEND_BURST = 6
+GLOBAL_SEND_RATE = 30.0
+GLOBAL_SEND_BURST = 30
+CHAT_BUCKETS_LIMIT = 10000
+SEND_MAX_RETRIES = 3
+SEND_POLL_INTERVAL = 0.01
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд; более важные ожидающие идут первыми"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiting = [0] * PRIORITY_LEVELS
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_idle(self):
+        self.refill()
+        return self.tokens >= self.capacity and not any(self.waiting)
+
+    async def acquire(self, priority=PRIORITY_INTERACTIVE):
+        self.waiting[priority] += 1
+        try:
+            while True:
+                self.refill()
+                if self.tokens >= 1 and not any(self.waiting[:priority]):
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(max((1 - self.tokens) / self.rate, SEND_POLL_INTERVAL))
+        finally:
+            self.waiting[priority] -= 1
+
+GLOBAL_SEND_BUCKET = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_BURST)
+CHAT_BUCKETS = {}
+
+def chat_bucket(chat_id):
+    bucket = CHAT_BUCKETS.get(chat_id)
+    if bucket is None:
+        if len(CHAT_BUCKETS) >= CHAT_BUCKETS_LIMIT:
+            # Полные вёдра без ожидающих ничего не ограничивают, их можно забыть
+            for idle_chat_id in [key for key, value in CHAT_BUCKETS.items() if value.is_idle()]:
+                del CHAT_BUCKETS[idle_chat_id]
+        bucket = TokenBucket(CHAT_SEND_RATE, CHAT_SEND_BURST)
+        CHAT_BUCKETS[chat_id] = bucket
+    return bucket
+
+async def send_outbound(chat_id, send, priority=PRIORITY_INTERACTIVE):
+    """Отправить сообщение с учётом лимитов чата и бота; send возвращает корутину отправки"""
+    with trace_span("send", priority=priority) as span:
+        attempt = 0
+        while True:
+            # Повтор после RetryAfter тоже берёт токены, иначе он обгонит очередь
+            queued_at = time.monotonic()
+            await chat_bucket(chat_id).acquire(priority)
+            await GLOBAL_SEND_BUCKET.acquire(priority)
+            queue_delay = time.monotonic() - queued_at
+            observe_metric(f"send_queue_delay_p{priority}", queue_delay)
+            span.set_attribute("queue_delay_ms", round(queue_delay * 1000))
+            try:
+                result = await send()
+                inc_metric("messages_sent")
+                return result
+            except RetryAfter as e:
+                attempt += 1
+                inc_metric("send_retry_after")
+                span.set_attribute("retry_after_count", attempt)
+                if attempt > SEND_MAX_RETRIES:
+                    inc_metric("send_failed")
+                    raise
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                logger.warning("⚠️ Flood control для чата %s, повтор через %s с", chat_id, retry_after,
+                               extra={"event": "send_retry", "stage": "send"})
+                await asyncio.sleep(retry_after)
+
+async def send_reply(message, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """Ответить на сообщение через планировщик отправки"""
+    return await send_outbound(message.chat_id, lambda: message.reply_text(text, **kwargs), priority)
+
+async def send_to_chat(bot, chat_id, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """Отправить сообщение в чат через планировщик отправки"""
+    return await send_outbound(chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs), priority)
+# --- КОНЕЦ: Отправка сообщений ---
+
+# --- НАЧАЛО: Уведомления администратору ---
+# immediate — каждое событие отдельным сообщением сразу; digest — сводкой раз в ADMIN_DIGEST_INTERVAL секунд
+ADMIN_NOTIFY_MODE = os.getenv("ADMIN_NOTIFY_MODE", "immediate")
+ADMIN_DIGEST_INTERVAL = int(os.getenv("ADMIN_DIGEST_INTERVAL", "900"))
+ADMIN_RETRY_INTERVAL = 60
+ADMIN_NOTIFICATIONS_PATH = os.getenv("ADMIN_NOTIFICATIONS_PATH", "admin_notifications.json")
+ADMIN_MESSAGE_LIMIT = 4000  # Запас до лимита Telegram в 4096 символов
+
+ADMIN_NOTIFICATIONS = []    # Ещё не отправленные уведомления; дублируются на диск
+ADMIN_FLUSH_LOCK = asyncio.Lock()
+
+def save_admin_notifications():
+    temp_path = f"{ADMIN_NOTIFICATIONS_PATH}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(ADMIN_NOTIFICATIONS, f, ensure_ascii=False)
+    os.replace(temp_path, ADMIN_NOTIFICATIONS_PATH)
+
+def load_admin_notifications():
+    """Вернуть в очередь уведомления, не отправленные до перезапуска"""
+    if not os.path.exists(ADMIN_NOTIFICATIONS_PATH):
+        return
+    try:
+        with open(ADMIN_NOTIFICATIONS_PATH, encoding="utf-8") as f:
+            ADMIN_NOTIFICATIONS.extend(json.load(f))
+    except Exception as e:
+        logger.error(f"❌ Не удалось прочитать {ADMIN_NOTIFICATIONS_PATH}: {e}")
+    if ADMIN_NOTIFICATIONS:
+        logger.info(f"📬 Неотправленных уведомлений администратору: {len(ADMIN_NOTIFICATIONS)}")
+
+def notify_admin(bot, kind, text, parse_mode=None, amount=0, plain_text=None):
+    """Поставить уведомление администратору в очередь; отправка идёт вне обработки апдейта.
+    plain_text — тот же текст без разметки для сводки, если text размечен"""
+    if not os.getenv("ADMIN_TELEGRAM_ID"):
+        logger.warning(f"⚠️ ADMIN_TELEGRAM_ID не установлен. Уведомление не отправлено: {text}")
+        return
+    ADMIN_NOTIFICATIONS.append({
+        "kind": kind,
+        "text": text,
+        "parse_mode": parse_mode,
+        "plain_text": plain_text or text,
+        "amount": amount,
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    })
+    try:
+        save_admin_notifications()
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения уведомлений администратору: {e}")
+    if ADMIN_NOTIFY_MODE != "digest":
+        spawn(flush_admin_notifications(bot))
+
+def build_admin_digest(notifications):
+    """Сводка уведомлений, разбитая на сообщения не длиннее ADMIN_MESSAGE_LIMIT:
+    пары (текст, сколько уведомлений из начала очереди в него вошло)"""
+    feedback_count = sum(1 for item in notifications if item["kind"] == "feedback")
+    donations = [item for item in notifications if item["kind"] == "donation"]
+    header = (
+        f"📬 Сводка ({notifications[0]['created_at']} — {notifications[-1]['created_at']})\n"
+        f"📩 Обратная связь: {feedback_count}\n"
+        f"💰 Донаты: {len(donations)} на {sum(item['amount'] for item in donations)} ⭐ Stars"
+    )
+    messages = [[header, 0]]
+    for item in notifications:
+        # Уведомления, сохранённые до появления plain_text, берём как есть
+        entry = f"[{item['created_at']}]\n{item.get('plain_text', item['text'])}"[:ADMIN_MESSAGE_LIMIT]
+        if len(messages[-1][0]) + len(entry) + 2 > ADMIN_MESSAGE_LIMIT:
+            messages.append([entry, 1])
+        else:
+            messages[-1][0] += f"\n\n{entry}"
+            messages[-1][1] += 1
+    return [tuple(message) for message in messages]
+
+async def flush_admin_notifications(bot):
+    """Отправить накопленные уведомления; неотправленные останутся до следующей попытки"""
+    async with ADMIN_FLUSH_LOCK:
+        if not ADMIN_NOTIFICATIONS:
+            return
+        admin_id = os.getenv("ADMIN_TELEGRAM_ID")
+        try:
+            chat_id = int(admin_id)
+        except (TypeError, ValueError) as ve:
+            logger.error(f"❌ ADMIN_TELEGRAM_ID имеет некорректное значение: {admin_id}. Ошибка: {ve}")
+            return
+        
+        batch = list(ADMIN_NOTIFICATIONS)
+        try:
+            if ADMIN_NOTIFY_MODE == "digest":
+                # Сводка идёт без разметки, чтобы пользовательский текст не ломал Markdown.
+                # Отправленные части сразу убираем из очереди: при сбое они не повторятся
+                for text, count in build_admin_digest(batch):
+                    await send_to_chat(bot, chat_id, text, priority=PRIORITY_ADMIN)
+                    del ADMIN_NOTIFICATIONS[:count]
+                    save_admin_notifications()
+            else:
+                for item in batch:
+                    try:
+                        await send_to_chat(bot, chat_id, item["text"], priority=PRIORITY_ADMIN, parse_mode=item["parse_mode"])
+                    except BadRequest:
+                        # Текст пользователя может ломать Markdown — отправляем без разметки
+                        await send_to_chat(bot, chat_id, item["text"], priority=PRIORITY_ADMIN)
+                    ADMIN_NOTIFICATIONS.remove(item)
+            logger.info(f"✅ Уведомления отправлены админу {admin_id}: {len(batch)}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка при отправке уведомлений админу: {e}")
+        save_admin_notifications()
+
+async def admin_notifications_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await flush_admin_notifications(context.bot)
+
+def schedule_admin_notifications(application):
+    """Периодическая отправка: сводки в режиме digest, повтор неудачных отправок в режиме immediate"""
+    load_admin_notifications()
+    interval = ADMIN_DIGEST_INTERVAL if ADMIN_NOTIFY_MODE == "digest" else ADMIN_RETRY_INTERVAL
+    first = interval if ADMIN_NOTIFY_MODE == "digest" else 0
+    application.job_queue.run_repeating(admin_notifications_job, interval=interval, first=first, name="admin_notifications")
+# --- КОНЕЦ: Уведомления администратору ---
+
+# --- НАЧАЛО: Платежи ---
+# Каждый платёж сначала дописывается в локальный журнал (по одной JSON-строке), и только потом
+# асинхронно уходит в аналитику и уведомление администратору. Ключ — telegram_payment_charge_id,
+# поэтому повторно доставленный апдейт не учитывается дважды. Статусы: received → queued
+# (уведомление сохранено) → done (строка записана в Google Sheets).
+PAYMENTS_WAL_PATH = os.getenv("PAYMENTS_WAL_PATH", "payments.wal")
+
+PAYMENT_JOURNAL = None          # charge_id → последняя запись журнала; загружается при первом обращении
+PAYMENT_JOURNAL_LOCK = asyncio.Lock()
+
+def load_payment_journal():
+    journal = {}
+    if not os.path.exists(PAYMENTS_WAL_PATH):
+        return journal
+    with open(PAYMENTS_WAL_PATH, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Недописанная строка после аварийной остановки
+                logger.warning(f"⚠️ Пропущена повреждённая строка журнала платежей: {line[:100]}")
+                continue
+            journal[record["charge_id"]] = record
+    return journal
+
+def append_payment_journal(record):
+    """Дописать запись в журнал и дождаться её сброса на диск"""
+    with open(PAYMENTS_WAL_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+async def get_payment_journal():
+    global PAYMENT_JOURNAL
+    if PAYMENT_JOURNAL is None:
+        PAYMENT_JOURNAL = await asyncio.to_thread(load_payment_journal)
+    return PAYMENT_JOURNAL
+
+async def record_payment(bot, user, payment):
+    """Записать платёж в журнал и запустить его обработку; False, если платёж уже был записан"""
+    charge_id = payment.telegram_payment_charge_id
+    async with PAYMENT_JOURNAL_LOCK:
+        journal = await get_payment_journal()
+        if charge_id in journal:
+            inc_metric("payments_duplicate")
+            logger.warning(f"⚠️ Повторная доставка платежа {charge_id} от {user.id}, пропускаю")
+            return False
+        record = {
+            "charge_id": charge_id,
+            "status": "received",
+            "user": user_snapshot(user),
+            "amount": payment.total_amount,
+            "payload": payment.invoice_payload,
+            "received_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        await asyncio.to_thread(append_payment_journal, record)
+        journal[charge_id] = record
+    inc_metric("payments_received")
+    spawn(fan_out_payment(bot, record))
+    return True
+
+async def set_payment_status(charge_id, status):
+    async with PAYMENT_JOURNAL_LOCK:
+        journal = await get_payment_journal()
+        record = dict(journal[charge_id], status=status)
+        await asyncio.to_thread(append_payment_journal, record)
+        journal[charge_id] = record
+
+async def mark_payment_logged(charge_id):
+    """Строка доната записана в Google Sheets: платёж обработан полностью"""
+    try:
+        await set_payment_status(charge_id, "done")
+    except Exception as e:
+        # Платёж останется в статусе queued; при повторе возможна лишняя строка, но не потеря
+        logger.error(f"❌ Ошибка записи в журнал платежей {charge_id}: {e}")
+
+async def fan_out_payment(bot, record):
+    """Уведомить администратора и поставить строку доната в очередь аналитики.
+    received → queued, когда уведомление сохранено; queued → done, когда строка записана в таблицу"""
+    charge_id = record["charge_id"]
+    user = SimpleNamespace(**record["user"])
+    try:
+        if record["status"] == "received":
+            notify_admin(
+                bot,
+                "donation",
+                f"💰 Получен донат!\n"
+                f"От: @{user.username} (ID: {user.id})\n"
+                f"Сумма: {record['amount']} ⭐ Stars\n"
+                f"Payload: {record['payload']}",
+                amount=record["amount"]
+            )
+            await set_payment_status(charge_id, "queued")
+        if not ANALYTICS_ENABLED:
+            await set_payment_status(charge_id, "done")
+        elif not any(op.get("charge_id") == charge_id for op in ANALYTICS_QUEUE):
+            # После штатной остановки строка уже могла вернуться в очередь из pending_jobs.json
+            log_donation(user, record["amount"], record["payload"], charge_id)
+    except Exception as e:
+        # Запись останется в журнале необработанной и будет дообработана при следующем запуске
+        logger.error(f"❌ Ошибка обработки платежа {charge_id}: {e}")
+
+async def replay_payment_journal(bot):
+    """Дообработать платежи, записанные в журнал, но не доведённые до конца до перезапуска"""
+    journal = await get_payment_journal()
+    pending = [record for record in journal.values() if record["status"] != "done"]
+    if pending:
+        logger.info(f"▶️ Дообрабатываю платежи из журнала: {len(pending)}")
+    for record in pending:
+        await fan_out_payment(bot, record)
+# --- КОНЕЦ: Платежи ---
+
+# --- НАЧАЛО: Фильтр похожих вариантов ---
+RECENT_VARIANTS_LIMIT = 30       # Сколько последних вариантов помним на пользователя
+NEAR_DUPLICATE_THRESHOLD = 0.6   # Доля совпавших корзин MinHash, начиная с которой вариант считается повтором
+NEAR_DUPLICATE_RETRIES = 1       # Сколько раз догенерировать варианты взамен повторов
+MINHASH_BINS = 64
+SHINGLE_SIZE = 4
+EMPTY_BIN = 0xFFFFFFFF
+
+recent_variants = {}
+
+def variant_signature(text):
+    """Компактная MinHash-подпись текста (одна хеш-функция, MINHASH_BINS корзин по символьным шинглам)"""
+    # Смайлики и пунктуация не влияют на смысл и меняются от варианта к варианту
+    normalized = " ".join(re.findall(r"\w+", text.lower()))
+    bins = [EMPTY_BIN] * MINHASH_BINS
+    for i in range(max(len(normalized) - SHINGLE_SIZE + 1, 1)):
+        h = zlib.crc32(normalized[i:i + SHINGLE_SIZE].encode())
+        b = h % MINHASH_BINS
+        if h < bins[b]:
+            bins[b] = h
+    return tuple(bins)
+
+def max_similarity(signature, signatures):
+    """Максимальная оценка сходства подписи с набором подписей (сравнение поэлементно в C через map)"""
+    best = 0
+    for other in signatures:
+        matches = sum(map(operator.eq, signature, other))
+        if matches > best:
+            best = matches
+    return best / MINHASH_BINS
+
+def filter_near_duplicates(user_id, variants):
+    """Разделить варианты на новые и почти повторяющие то, что пользователь уже видел"""
+    seen = list(recent_variants.get(user_id, ()))
+    fresh, duplicates = [], []
+    for variant in variants:
+        signature = variant_signature(variant)
+        if max_similarity(signature, seen) >= NEAR_DUPLICATE_THRESHOLD:
+            duplicates.append(variant)
+        else:
+            fresh.append(variant)
+            # Повторы внутри одного ответа тоже отсеиваем
+            seen.append(signature)
+    return fresh, duplicates
+
+def remember_variants(user_id, variants):
+    """Запомнить отправленные варианты; самые старые вытесняются при превышении лимита"""
+    memory = recent_variants.get(user_id)
+    if memory is None:
+        memory = deque(maxlen=RECENT_VARIANTS_LIMIT)
+        recent_variants[user_id] = memory
+    for variant in variants:
+        memory.append(variant_signature(variant))
+# --- КОНЕЦ: Фильтр похожих вариантов ---
+
+# --- НАЧАЛО: Хранилище поздравлений ---
+GREETING_STORE_PATH = os.getenv("GREETING_STORE_PATH", "greetings.db")
+GREETING_STORE_MIN_QUALITY = 0.5  # Варианты с оценкой ниже в хранилище не попадают
+INSTANT_VARIANTS_COUNT = 3        # Столько вариантов нужно, чтобы ответить без OpenAI
+RANDOM_KEY_BITS = 62
+
+GREETING_STORE = None
+
+GREETING_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS greetings (
+    id INTEGER PRIMARY KEY,
+    subcategory TEXT NOT NULL,
+    style TEXT NOT NULL,
+    emojis INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    text_hash INTEGER NOT NULL UNIQUE,
+    quality REAL NOT NULL,
+    rnd INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_greetings_lookup ON greetings (subcategory, style, emojis, rnd);
+CREATE INDEX IF NOT EXISTS idx_greetings_quality ON greetings (subcategory, quality);
+CREATE TABLE IF NOT EXISTS served (
+    user_id INTEGER NOT NULL,
+    greeting_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, greeting_id)
+) WITHOUT ROWID;
+"""
+
+def get_greeting_store():
+    """Открыть хранилище поздравлений при первом обращении, а не при старте бота"""
+    global GREETING_STORE
+    if GREETING_STORE is None:
+        conn = sqlite3.connect(GREETING_STORE_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(GREETING_STORE_SCHEMA)
+        GREETING_STORE = conn
+        logger.info(f"🗄 Хранилище поздравлений открыто: {GREETING_STORE_PATH}")
+    return GREETING_STORE
+
+def score_variant(text):
+    """Простая оценка качества варианта от 0 до 1"""
+    lowered = text.lower()
+    if "chatgpt" in lowered or "openai" in lowered:
+        return 0.0
+    score = 1.0
+    if len(text) < 40 or len(text) > 1500:
+        score -= 0.5
+    if "—" in text:
+        score -= 0.2
+    if "желаю счастья, здоровья" in lowered:
+        score -= 0.3
+    return max(score, 0.0)
+
+def save_greetings(user_id, subcategory, style, emojis, variants):
+    """Сохранить удачные варианты и отметить их как показанные пользователю"""
+    try:
+        conn = get_greeting_store()
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with conn:
+            for variant in variants:
+                quality = score_variant(variant)
+                if quality < GREETING_STORE_MIN_QUALITY:
+                    continue
+                text_hash = int.from_bytes(hashlib.blake2b(variant.encode(), digest_size=8).digest(), "big", signed=True)
+                conn.execute(
+                    "INSERT OR IGNORE INTO greetings (subcategory, style, emojis, text, text_hash, quality, rnd, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (subcategory, style, int(emojis), variant, text_hash, quality, random.getrandbits(RANDOM_KEY_BITS), now)
+                )
+                conn.execute(
+                    "INSERT OR IGNORE INTO served (user_id, greeting_id) SELECT ?, id FROM greetings WHERE text_hash = ?",
+                    (user_id, text_hash)
+                )
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения поздравлений: {e}")
+
+def pick_stored_greetings(user_id, subcategory, style, emojis, count):
+    """Случайные поздравления из хранилища, которые пользователь ещё не видел"""
+    conn = get_greeting_store()
+    # Случайный ключ rnd входит в индекс: начинаем с произвольной точки и идём по индексу,
+    # вместо ORDER BY RANDOM() по всей выборке
+    pivot = random.getrandbits(RANDOM_KEY_BITS)
+    query = (
+        "SELECT id, text FROM greetings AS g "
+        "WHERE subcategory = ? AND style = ? AND emojis = ? AND rnd {op} ? "
+        "AND NOT EXISTS (SELECT 1 FROM served AS s WHERE s.user_id = ? AND s.greeting_id = g.id) "
+        "ORDER BY rnd LIMIT ?"
+    )
+    rows = conn.execute(query.format(op=">="), (subcategory, style, int(emojis), pivot, user_id, count)).fetchall()
+    if len(rows) < count:
+        rows += conn.execute(query.format(op="<"), (subcategory, style, int(emojis), pivot, user_id, count - len(rows))).fetchall()
+    return rows
+
+def mark_greetings_served(user_id, greeting_ids):
+    """Отметить поздравления как показанные пользователю"""
+    conn = get_greeting_store()
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO served (user_id, greeting_id) VALUES (?, ?)",
+            [(user_id, greeting_id) for greeting_id in greeting_ids]
+        )
+
+def pick_instant_variants(user_id, subcategory, style, emojis):
+    """Готовые варианты из хранилища вместо обращения к OpenAI; пустой список, если их не хватает"""
+    try:
+        rows = pick_stored_greetings(user_id, subcategory, style, emojis, INSTANT_VARIANTS_COUNT)
+        if len(rows) < INSTANT_VARIANTS_COUNT:
+            return []
+        fresh, _ = filter_near_duplicates(user_id, [text for _, text in rows])
+        if len(fresh) < INSTANT_VARIANTS_COUNT:
+            return []
+        # Показанными отмечаем только то, что действительно отдаём пользователю
+        mark_greetings_served(user_id, [greeting_id for greeting_id, _ in rows])
+        return fresh
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения хранилища поздравлений: {e}")
+        return []
+# --- КОНЕЦ: Хранилище поздравлений ---
+
+# --- НАЧАЛО: Персонализация по имени ---
+PERSONALIZATION_CANDIDATES = 12  # Сколько сохранённых вариантов пробуем подставить имя
+
+# Локальный словарь имён: род (m/f/u) и, для нерегулярных имён, готовые формы (дательный, винительный)
+NAME_DICTIONARY = {
+    "m": [
+        "александр", "алексей", "анатолий", "андрей", "антон", "аркадий", "артём", "артем", "борис",
+        "вадим", "валентин", "валерий", "василий", "виктор", "виталий", "владимир", "владислав",
+        "вячеслав", "геннадий", "георгий", "глеб", "григорий", "даниил", "денис", "дмитрий", "евгений",
+        "егор", "иван", "игорь", "илья", "кирилл", "константин", "леонид", "максим", "марк", "матвей",
+        "михаил", "никита", "николай", "олег", "роман", "руслан", "семён", "семен", "сергей", "станислав",
+        "степан", "тимофей", "тимур", "фёдор", "федор", "юрий", "ярослав", "дима", "миша", "коля",
+        "серёжа", "сережа", "вова", "паша", "петя", "лёша", "леша", "гоша", "витя", "костя", "слава",
+    ],
+    "f": [
+        "александра", "алина", "алиса", "алла", "анастасия", "анна", "антонина", "валентина", "валерия",
+        "вера", "вероника", "виктория", "галина", "дарья", "диана", "ева", "евгения", "екатерина",
+        "елена", "елизавета", "жанна", "зинаида", "зоя", "инна", "ирина", "карина", "кира", "клавдия",
+        "кристина", "ксения", "лариса", "лидия", "людмила", "маргарита", "марина", "мария", "милана",
+        "надежда", "наталья", "наталия", "нина", "оксана", "ольга", "полина", "раиса", "светлана",
+        "софия", "софья", "тамара", "татьяна", "ульяна", "юлия", "яна", "аня", "катя", "маша", "оля",
+        "наташа", "таня", "лена", "юля", "настя", "даша", "света", "ира", "люда", "галя", "надя",
+    ],
+    "u": ["саша", "женя", "валя", "шура"],
+}
+NAME_FORM_EXCEPTIONS = {
+    "павел": ("m", "Павлу", "Павла"),
+    "лев": ("m", "Льву", "Льва"),
+    "пётр": ("m", "Петру", "Петра"),
+    "петр": ("m", "Петру", "Петра"),
+    "любовь": ("f", "Любови", "Любовь"),
+}
+NAME_GENDERS = {name: gender for gender, names in NAME_DICTIONARY.items() for name in names}
+
+ADDRESS_ADJECTIVES = {
+    "formal": ("Уважаемый", "Уважаемая"),
+    "romantic": ("Милый", "Милая"),
+}
+DEFAULT_ADDRESS_ADJECTIVES = ("Дорогой", "Дорогая")
+
+# Обращения к безымянному адресату, которые модель пишет для "поздравление для друга"
+GENERIC_ADDRESS_RE = re.compile(r"\b(?:[Дд]орогой|[Мм]илый|[Мм]ой) друг\b")
+GENERIC_DATIVE_RE = re.compile(r"\b(?:[Дд]орогому |[Мм]оему )?другу\b")
+GENERIC_ACCUSATIVE_RE = re.compile(r"\b([Зз]а) (?:нашего )?друга\b")
+MASCULINE_ADDRESS_RE = re.compile(r"\b(?:дорогой|милый|любимый|самый|родной|мой друг)\b", re.IGNORECASE)
+FEMININE_ADDRESS_RE = re.compile(r"\b(?:дорогая|милая|любимая|самая|родная)\b", re.IGNORECASE)
+
+def inflect_name(name):
+    """Формы имени по локальному словарю: (род, именительный, дательный, винительный) или None"""
+    key = name.strip().lower()
+    if key in NAME_FORM_EXCEPTIONS:
+        gender, dative, accusative = NAME_FORM_EXCEPTIONS[key]
+        return gender, key.capitalize(), dative, accusative
+    gender = NAME_GENDERS.get(key)
+    if gender is None:
+        return None
+    
+    nominative = key.capitalize()
+    stem = nominative[:-1]
+    if key.endswith("ия"):
+        return gender, nominative, stem + "и", stem + "ю"
+    if key.endswith("а"):
+        return gender, nominative, stem + "е", stem + "у"
+    if key.endswith("я"):
+        return gender, nominative, stem + "е", stem + "ю"
+    if key.endswith(("й", "ь")):
+        return gender, nominative, stem + "ю", stem + "я"
+    return gender, nominative, nominative + "у", nominative + "а"
+
+def personalize_greeting(text, style, forms, is_toast):
+    """Вставить имя в сохранённое поздравление; None, если результат не проходит проверку"""
+    gender, nominative, dative, accusative = forms
+    masculine, feminine = ADDRESS_ADJECTIVES.get(style, DEFAULT_ADDRESS_ADJECTIVES)
+    if gender == "u":
+        address = nominative
+    else:
+        address = f"{feminine if gender == 'f' else masculine} {nominative}"
+    
+    # Обращение посреди предложения оставляем со строчной буквы
+    personalized, replaced = GENERIC_ADDRESS_RE.subn(
+        lambda m: address if m.group(0)[0].isupper() else address[0].lower() + address[1:], text
+    )
+    personalized, count = GENERIC_DATIVE_RE.subn(dative, personalized)
+    replaced += count
+    personalized, count = GENERIC_ACCUSATIVE_RE.subn(lambda m: f"{m.group(1)} {accusative}", personalized)
+    replaced += count
+    
+    if not replaced:
+        if is_toast:
+            personalized = f"{personalized}\n\nЗа {accusative}!"
+        else:
+            personalized = f"{address}!\n\n{personalized}"
+    
+    # Проверки качества: род обращений должен совпадать с именем
+    if gender == "f" and MASCULINE_ADDRESS_RE.search(personalized):
+        return None
+    if gender == "m" and FEMININE_ADDRESS_RE.search(personalized):
+        return None
+    if score_variant(personalized) < GREETING_STORE_MIN_QUALITY:
+        return None
+    return personalized
+
+def pick_personalized_variants(user_id, subcategory, style, emojis, name):
+    """Готовые варианты из хранилища с подставленным именем; пустой список, если не получилось"""
+    forms = inflect_name(name)
+    # Сохранённые варианты написаны для "друга" и согласованы в мужском роде целиком
+    # («ты всегда был рядом», «который»): для женских имён это не исправить заменой обращения
+    if forms is None or forms[0] == "f":
+        return []
+    try:
+        rows = pick_stored_greetings(user_id, subcategory, style, emojis, PERSONALIZATION_CANDIDATES)
+        is_toast = subcategory.startswith('toast_')
+        chosen = []
+        for greeting_id, text in rows:
+            personalized = personalize_greeting(text, style, forms, is_toast)
+            if personalized:
+                chosen.append((greeting_id, personalized))
+            if len(chosen) == INSTANT_VARIANTS_COUNT:
+                break
+        if len(chosen) < INSTANT_VARIANTS_COUNT:
+            return []
+        fresh, _ = filter_near_duplicates(user_id, [text for _, text in chosen])
+        if len(fresh) < INSTANT_VARIANTS_COUNT:
+            return []
+        mark_greetings_served(user_id, [greeting_id for greeting_id, _ in chosen])
+        return fresh
+    except Exception as e:
+        logger.error(f"❌ Ошибка персонализации поздравлений: {e}")
+        return []
+# --- КОНЕЦ: Персонализация по имени ---
+
+# --- НАЧАЛО: Отложенная отправка ---
+# Запланированные поздравления лежат в SQLite; в памяти — только куча (due_at, id)
+# на ближайшее окно, её пополняет и разбирает периодическая задача JobQueue
+SCHEDULE_TIMEZONE = os.getenv("SCHEDULE_TIMEZONE", "Europe/Moscow")
+SCHEDULE_TZ = ZoneInfo(SCHEDULE_TIMEZONE)
+SCHEDULE_TICK_INTERVAL = 5      # сек между проверками кучи
+SCHEDULE_WINDOW = 600           # сек: в кучу загружается то, что наступит в ближайшие 10 минут
+SCHEDULE_HEAP_LIMIT = 50000     # записей в памяти, остальное дочитывается по мере отправки
+SCHEDULE_BATCH = int(GLOBAL_SEND_RATE * SCHEDULE_TICK_INTERVAL)  # одновременных отправок не больше
+SCHEDULE_MAX_PER_USER = 20
+SCHEDULE_MAX_AHEAD = timedelta(days=366)
+SCHEDULE_DEFAULT_HOUR = 9
+SCHEDULE_RETRY_DELAY = 300
+SCHEDULE_MAX_ATTEMPTS = 3
+
+SCHEDULE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scheduled (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    due_at INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_scheduled_due ON scheduled (due_at);
+CREATE INDEX IF NOT EXISTS idx_scheduled_user ON scheduled (user_id);
+"""
+SCHEDULE_DATE_RE = re.compile(r"^\s*(\d{1,2})\.(\d{1,2})(?:\.(\d{2}|\d{4}))?(?:\s+(\d{1,2})[:.](\d{2}))?\s*$")
+
+SCHEDULE_HEAP = []
+SCHEDULE_CURSOR = (0, 0)  # (due_at, id) последней записи, загруженной в кучу
+SCHEDULE_DELIVERIES = set()
+SCHEDULE_SCHEMA_READY = False
+
+def get_schedule_store():
+    global SCHEDULE_SCHEMA_READY
+    conn = get_greeting_store()
+    if not SCHEDULE_SCHEMA_READY:
+        conn.executescript(SCHEDULE_SCHEMA)
+        SCHEDULE_SCHEMA_READY = True
+    return conn
+
+def parse_schedule_date(text, now):
+    """Дата отправки из «ДД.ММ[.ГГГГ] [ЧЧ:ММ]»; None, если не разобрать.
+    Без года берётся ближайший год, в котором этот день ещё не прошёл (для 29.02 — високосный)"""
+    match = SCHEDULE_DATE_RE.match(text)
+    if not match:
+        return None
+    day, month, year, hour, minute = match.groups()
+    if year:
+        years = [int(f"20{year}" if len(year) == 2 else year)]
+    else:
+        # Между високосными годами бывает до 8 лет (2096 → 2104)
+        years = range(now.year, now.year + 9)
+    for candidate in years:
+        try:
+            due = datetime(
+                candidate, int(month), int(day),
+                int(hour) if hour else SCHEDULE_DEFAULT_HOUR, int(minute) if minute else 0,
+                tzinfo=now.tzinfo
+            )
+        except ValueError:
+            continue
+        # Сегодняшняя дата остаётся в этом году: если время уже прошло, пользователь узнает об этом
+        if year or due.date() >= now.date():
+            return due
+    return None
+
+def track_scheduled(due_at, delivery_id):
+    """Запись раньше курсора сама в кучу уже не попадёт, поэтому кладём её сразу"""
+    if (due_at, delivery_id) <= SCHEDULE_CURSOR:
+        heapq.heappush(SCHEDULE_HEAP, (due_at, delivery_id))
+
+def add_scheduled_greeting(user_id, chat_id, due_at, text):
+    """Запланировать отправку; None, если у пользователя уже слишком много запланированного"""
+    conn = get_schedule_store()
+    with conn:
+        (pending,) = conn.execute("SELECT COUNT(*) FROM scheduled WHERE user_id = ?", (user_id,)).fetchone()
+        if pending >= SCHEDULE_MAX_PER_USER:
+            return None
+        delivery_id = conn.execute(
+            "INSERT INTO scheduled (user_id, chat_id, due_at, text) VALUES (?, ?, ?, ?)",
+            (user_id, chat_id, due_at, text)
+        ).lastrowid
+    track_scheduled(due_at, delivery_id)
+    inc_metric("scheduled_added")
+    return delivery_id
+
+def refill_schedule(now):
+    """Дочитать в кучу записи, наступающие в ближайшее окно"""
+    global SCHEDULE_CURSOR
+    room = SCHEDULE_HEAP_LIMIT - len(SCHEDULE_HEAP)
+    if room <= 0:
+        return
+    rows = get_schedule_store().execute(
+        "SELECT due_at, id FROM scheduled WHERE (due_at, id) > (?, ?) AND due_at < ? ORDER BY due_at, id LIMIT ?",
+        (*SCHEDULE_CURSOR, int(now) + SCHEDULE_WINDOW, room)
+    ).fetchall()
+    for row in rows:
+        heapq.heappush(SCHEDULE_HEAP, row)
+    if rows:
+        SCHEDULE_CURSOR = rows[-1]
+
+async def deliver_scheduled(bot, delivery_id):
+    """Отправить запланированное поздравление; запись удаляется только после успешной отправки"""
+    conn = get_schedule_store()
+    row = conn.execute("SELECT chat_id, text, attempts FROM scheduled WHERE id = ?", (delivery_id,)).fetchone()
+    if row is None:
+        return
+    chat_id, text, attempts = row
+    try:
+        await send_to_chat(bot, chat_id, text, priority=PRIORITY_SCHEDULED)
+    except Forbidden:
+        # Пользователь заблокировал бота: повторять бессмысленно
+        logger.warning("⚠️ Запланированное поздравление %s не доставлено: бот заблокирован в чате %s", delivery_id, chat_id,
+                       extra={"event": "scheduled_failed", "stage": "send"})
+        inc_metric("scheduled_failed")
+    except Exception as e:
+        if attempts + 1 < SCHEDULE_MAX_ATTEMPTS:
+            retry_at = int(time.time()) + SCHEDULE_RETRY_DELAY
+            with conn:
+                conn.execute("UPDATE scheduled SET due_at = ?, attempts = ? WHERE id = ?", (retry_at, attempts + 1, delivery_id))
+            track_scheduled(retry_at, delivery_id)
+            logger.warning("⚠️ Ошибка отправки запланированного поздравления %s, повтор через %s с: %s",
+                           delivery_id, SCHEDULE_RETRY_DELAY, e, extra={"event": "scheduled_retry", "stage": "send"})
+            return
+        logger.error("❌ Запланированное поздравление %s не доставлено: %s", delivery_id, e,
+                     extra={"event": "scheduled_failed", "stage": "send"})
+        inc_metric("scheduled_failed")
+    else:
+        inc_metric("scheduled_delivered")
+    with conn:
+        conn.execute("DELETE FROM scheduled WHERE id = ?", (delivery_id,))
+
+async def scheduled_delivery_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Разобрать наступившие записи; за один проход не больше, чем успеет уйти с лимитом отправки"""
+    now = time.time()
+    refill_schedule(now)
+    while SCHEDULE_HEAP and SCHEDULE_HEAP[0][0] <= now and len(SCHEDULE_DELIVERIES) < SCHEDULE_BATCH:
+        _, delivery_id = heapq.heappop(SCHEDULE_HEAP)
+        task = spawn(deliver_scheduled(context.bot, delivery_id))
+        SCHEDULE_DELIVERIES.add(task)
+        task.add_done_callback(SCHEDULE_DELIVERIES.discard)
+
+def schedule_deliveries(application):
+    application.job_queue.run_repeating(
+        scheduled_delivery_job, interval=SCHEDULE_TICK_INTERVAL, first=0, name="scheduled_deliveries"
+    )
+# --- КОНЕЦ: Отложенная отправка ---
+
+# --- НАЧАЛО: Защита от деградации OpenAI ---
+# Предохранитель следит за задержкой и долей ошибок OpenAI в скользящем окне. При превышении порогов
+# бот переходит в деградированный режим: отдаёт сохранённые варианты, а если их нет — делает короткий
+# запрос без смайликов. Через BREAKER_OPEN_SECONDS пропускается один пробный обычный запрос:
+# успех закрывает предохранитель, ошибка снова открывает его.
+BREAKER_WINDOW_SECONDS = 60
+BREAKER_MIN_SAMPLES = 5
+BREAKER_ERROR_RATE = 0.5
+BREAKER_LATENCY_SECONDS = float(os.getenv("BREAKER_LATENCY_SECONDS", "15"))  # Средняя задержка в окне
+BREAKER_OPEN_SECONDS = 30
+OPENAI_TIMEOUT = 60
+DEGRADED_OPENAI_TIMEOUT = 20
+DEFAULT_MAX_TOKENS = 2500
+DEGRADED_MAX_TOKENS = 800
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+BREAKER_STATES = (BREAKER_CLOSED, BREAKER_HALF_OPEN, BREAKER_OPEN)
+
+OPENAI_NORMAL = "normal"
+OPENAI_PROBE = "probe"
+OPENAI_DEGRADED = "degraded"
+
+breaker_state = BREAKER_CLOSED
+breaker_opened_at = 0.0
+breaker_probe_in_flight = False
+openai_samples = deque()  # (время, задержка, успех)
+# Суммы по окну ведутся вместе с очередью: пересчёт по всему окну на каждый запрос растёт с нагрузкой
+openai_window_errors = 0
+openai_window_latency = 0.0
+
+def set_breaker_state(state):
+    global breaker_state, breaker_opened_at
+    logger.warning(f"⚠️ Предохранитель OpenAI: {breaker_state} → {state}")
+    breaker_state = state
+    if state == BREAKER_OPEN:
+        breaker_opened_at = time.monotonic()
+    inc_metric(f"breaker_transitions_{state}")
+    METRICS["breaker_state"] = BREAKER_STATES.index(state)
+
+def openai_mode():
+    """Каким будет следующий запрос к OpenAI: обычным, пробным или деградированным"""
+    global breaker_probe_in_flight
+    if breaker_state == BREAKER_OPEN and time.monotonic() - breaker_opened_at >= BREAKER_OPEN_SECONDS:
+        set_breaker_state(BREAKER_HALF_OPEN)
+    if breaker_state == BREAKER_CLOSED:
+        return OPENAI_NORMAL
+    if breaker_state == BREAKER_HALF_OPEN and not breaker_probe_in_flight:
+        breaker_probe_in_flight = True
+        return OPENAI_PROBE
+    return OPENAI_DEGRADED
+
+def record_openai_result(mode, latency, ok):
+    """Учесть результат запроса к OpenAI и при необходимости переключить предохранитель"""
+    global breaker_probe_in_flight, openai_window_errors, openai_window_latency
+    observe_metric("openai_latency", latency)
+    if not ok:
+        inc_metric("openai_errors")
+    
+    if mode == OPENAI_PROBE:
+        breaker_probe_in_flight = False
+        if ok and latency < BREAKER_LATENCY_SECONDS:
+            openai_samples.clear()
+            openai_window_errors, openai_window_latency = 0, 0.0
+            set_breaker_state(BREAKER_CLOSED)
+        else:
+            set_breaker_state(BREAKER_OPEN)
+        return
+    if mode != OPENAI_NORMAL or breaker_state != BREAKER_CLOSED:
+        return
+    
+    now = time.monotonic()
+    openai_samples.append((now, latency, ok))
+    openai_window_errors += not ok
+    openai_window_latency += latency
+    while openai_samples and now - openai_samples[0][0] > BREAKER_WINDOW_SECONDS:
+        _, old_latency, old_ok = openai_samples.popleft()
+        openai_window_errors -= not old_ok
+        openai_window_latency -= old_latency
+    if len(openai_samples) < BREAKER_MIN_SAMPLES:
+        return
+    error_rate = openai_window_errors / len(openai_samples)
+    average_latency = openai_window_latency / len(openai_samples)
+    if error_rate >= BREAKER_ERROR_RATE or average_latency >= BREAKER_LATENCY_SECONDS:
+        logger.warning(f"⚠️ OpenAI деградировал: ошибок {error_rate:.0%}, средняя задержка {average_latency:.1f} с")
+        set_breaker_state(BREAKER_OPEN)
+
+def pick_degraded_variants(user_id, params):
+    """Сохранённые варианты с ослабленными условиями: подходят и другие стили, и варианты без смайликов"""
+    subcategory_key = store_subcategory(params)
+    style_ids = CATALOG.locale(params.get("locale")).style_ids
+    styles = [params["style"]] + [style for style in style_ids if style != params["style"]]
+    # Подстановка имени умеет только русскую грамматику
+    if params["name"] and subcategory_key != params["subcategory_key"]:
+        return []
+    # Без смайликов можно ответить и тому, кто их просил, но не наоборот
+    for emojis in dict.fromkeys((params["emojis"], False)):
+        for style in styles:
+            if params["name"]:
+                variants = pick_personalized_variants(user_id, subcategory_key, style, emojis, params["name"])
+            else:
+                variants = pick_instant_variants(user_id, subcategory_key, style, emojis)
+            if variants:
+                return variants
+    return []
+# --- КОНЕЦ: Защита от деградации OpenAI ---
+
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
@@ -190,11 +1473,83 @@ if not TELEGRAM_TOKEN:
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY не найден в переменных окружения")
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# --- НАЧАЛО: Логирование ---
+# Обработчики пишут записи в очередь, а форматирование и вывод идут в отдельном потоке QueueListener.
+# LOG_FORMAT: json (по умолчанию) или text; LOG_SAMPLE_RATES: "sheets_write=0.1,user_event=0.5" —
+# доля записей, которые оставляем для частых событий (поле event)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_FIELDS = ("event", "stage", "user_id", "latency_ms")
+
+def parse_sample_rates(value):
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        event, _, rate = item.partition("=")
+        rates[event.strip()] = float(rate)
+    return rates
+
+LOG_SAMPLE_RATES = parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись со структурными полями из extra"""
+    cached_second = None
+    cached_time = ""
+
+    def formatTime(self, record, datefmt=None):
+        # strftime на каждую запись заметен в потоке слушателя; секунда меняется реже, чем идут записи
+        second = int(record.created)
+        if second != self.cached_second:
+            self.cached_time = time.strftime("%Y-%m-%d %H:%M:%S", self.converter(second))
+            self.cached_second = second
+        return f"{self.cached_time},{int(record.msecs):03d}"
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только заданную долю записей для частых событий"""
+
+    def filter(self, record):
+        rate = LOG_SAMPLE_RATES.get(getattr(record, "event", None))
+        return rate is None or random.random() < rate
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке: сообщение соберёт QueueListener"""
+
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    # Остановка слушателя дописывает всё, что осталось в очереди
+    atexit.register(listener.stop)
+
+setup_logging()
 logger = logging.getLogger(__name__)
+# --- КОНЕЦ: Логирование ---
 
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
@@ -202,262 +1557,192 @@ import warnings
 from telegram.warnings import PTBUserWarning
 warnings.filterwarnings(action="ignore", message=r".*CallbackQueryHandler", category=PTBUserWarning)
 
-CATEGORY, SUBCATEGORY, STYLE, EMOJIS, NAME, GENERATE, FEEDBACK = range(7)
-
-MAIN_CATEGORIES = {
-    "toast": "🥂 Тосты",
-    "birthday": "🎂 Дни рождения",
-    "professional": "💼 Рабочие и профессиональные",
-    "seasonal": "🎄 Календарные / сезонные",
-    "personal": "❤️ Личные поводы и достижения",
-    "family": "👨‍👩‍👧‍👦 Семейные",
-    "donate": "☕ Поддержать проект",
-    "feedback": "✉️ Обратная связь",
-}
-
-SUBCATEGORIES = {
-    "toast": {
-        "toast_corporate": "На корпоративе",
-        "toast_wedding": "На свадьбе",
-        "toast_new_year": "На Новый год",
-        "toast_birthday": "На день рождения",
-        "toast_farewell": "Прощальный",
-        "toast_cocktail": "Коктейльный час",
-        "toast_romantic": "Романтический",
-        "toast_funny": "С юмором",
-    },
-    "birthday": {
-        "bd_gen": "универсальное",
-        "bd_friend": "для друзей",
-        "bd_relatives": "для родных",
-        "bd_colleague": "для коллег",
-        "bd_mother": "для мамы",
-        "bd_father": "для папы",
-        "bd_grandmother": "для бабушки",
-        "bd_grandfather": "для дедушки",
-        "bd_sister": "для сестры",
-        "bd_brother": "для брата",
-        "bd_child": "для ребёнка",
-        "bd_girlfriend": "для девушки",
-        "bd_boyfriend": "для молодого человека",
-    },
-    "professional": {
-        "defender_day": "С днём защитника Отечества",
-        "womens_day": "С 8 марта",
-        "teachers_day": "С днём учителя",
-        "doctors_day": "С днём врача",
-        "programmers_day": "С днём программиста",
-        "police_day": "С днём полиции",
-        "prosecutor_day": "С днём прокуратуры",
-        "lawyers_day": "С днём юриста",
-        "company_day": "С днём компании",
-        "promotion": "С повышением",
-        "retirement": "С выходом на пенсию",
-        "project_success": "С успешным проектом",
-        "report_submitted": "С сдачей отчёта",
-        "vacation_start": "С началом отпуска",
-        "vacation_end": "С окончанием отпуска",
-    },
-    "seasonal": {
-        "new_year": "С Новым годом",
-        "xmas": "С Рождеством",
-        "easter": "С Пасхой",
-        "victory_day": "С Днём Победы",
-        "city_day": "С Днём города",
-        "independence_day": "С Днём независимости",
-        "spring_start": "С началом весны",
-        "summer_start": "С началом лета",
-        "autumn_start": "С началом осени",
-        "winter_start": "С началом зимы",
-        "sep_1": "С 1 сентября",
-    },
-    "personal": {
-        "graduation": "С окончанием учёбы",
-        "diploma": "С получением диплома",
-        "car_purchase": "С покупкой машины",
-        "apartment_purchase": "С покупкой квартиры",
-        "house_purchase": "С покупкой дома",
-        "victory": "С победой",
-        "award": "С наградой",
-        "sports_success": "Со спортивным успехом",
-        "recovery": "С выздоровлением",
-        "discharge": "С выпиской",
-        "relations_anniversary": "С годовщиной отношений",
-        "friendship_anniversary": "С годовщиной дружбы",
-        "move": "С переездом",
-        "new_job": "С новой работой",
-    },
-    "family": {
-        "birth_child": "С рождением ребёнка",
-        "wedding": "Со свадьбой",
-        "engagement": "С помолвкой",
-        "proposal": "С предложением руки и сердца",
-        "wedding_anniversary": "С годовщиной свадьбы",
-        "mothers_day": "С днём матери",
-        "fathers_day": "С днём отца",
-        "family_day": "С днём семьи",
-        "valentines_day": "С днём святого Валентина",
-        "name_day": "С днём ангела",
-        "new_home": "С новосельем",
-    },
-}
-
-STYLES = {
-    "standard": "📝 Стандартное / универсальное",
-    "short": "✂️ Короткое / лаконичное",
-    "funny": "😄 Смешное / с юмором",
-    "warm": "❤️ Душевное / тёплое",
-    "formal": "💼 Официальное / деловое",
-    "romantic": "💕 Романтическое",
-}
-
-STYLE_DESCRIPTIONS = {
-    "standard": "нейтральное, вежливое, универсальное поздравление",
-    "short": "очень короткое, лаконичное, 1-2 предложения, без лишних слов",
-    "funny": "с юмором, лёгкая ирония, забавное, но не оскорбительное",
-    "warm": "душевное, тёплое, от сердца, с акцентом на чувства и эмоции",
-    "formal": "официальное, деловое, строгое, уважительный тон без шуток",
-    "romantic": "романтическое, нежное, мягкое, с акцентом на чувства",
-}
-
-CATEGORY_INTERNAL = {
-    "toast_corporate": "тост на корпоративе",
-    "toast_wedding": "тост на свадьбе",
-    "toast_new_year": "тост на Новый год",
-    "toast_birthday": "тост на день рождения",
-    "toast_farewell": "прощальный тост",
-    "toast_cocktail": "тост на коктейльном часу",
-    "toast_romantic": "романтический тост",
-    "toast_funny": "тост с юмором",
-    "bd_gen": "день рождения",
-    "bd_friend": "день рождения для друзей",
-    "bd_relatives": "день рождения для родных",
-    "bd_colleague": "день рождения для коллег",
-    "bd_mother": "день рождения для мамы",
-    "bd_father": "день рождения для папы",
-    "bd_grandmother": "день рождения для бабушки",
-    "bd_grandfather": "день рождения для дедушки",
-    "bd_sister": "день рождения для сестры",
-    "bd_brother": "день рождения для брата",
-    "bd_child": "день рождения для ребёнка",
-    "bd_girlfriend": "день рождения для девушки",
-    "bd_boyfriend": "день рождения для молодого человека",
-    "defender_day": "23 февраля",
-    "womens_day": "8 марта",
-    "teachers_day": "день учителя",
-    "doctors_day": "день врача",
-    "programmers_day": "день программиста",
-    "police_day": "день полиции",
-    "prosecutor_day": "день прокуратуры",
-    "lawyers_day": "день юриста",
-    "company_day": "день компании",
-    "promotion": "повышение",
-    "retirement": "выход на пенсию",
-    "project_success": "успешный проект",
-    "report_submitted": "сдача отчёта",
-    "vacation_start": "начало отпуска",
-    "vacation_end": "окончание отпуска",
-    "new_year": "Новый год",
-    "xmas": "Рождество",
-    "easter": "Пасха",
-    "victory_day": "9 мая",
-    "city_day": "день города",
-    "independence_day": "день независимости",
-    "spring_start": "начало весны",
-    "summer_start": "начало лета",
-    "autumn_start": "начало осени",
-    "winter_start": "начало зимы",
-    "sep_1": "1 сентября",
-    "graduation": "окончание учёбы",
-    "diploma": "получение диплома",
-    "car_purchase": "покупка машины",
-    "apartment_purchase": "покупка квартиры",
-    "house_purchase": "покупка дома",
-    "victory": "победа",
-    "award": "награда",
-    "sports_success": "спортивный успех",
-    "recovery": "выздоровление",
-    "discharge": "выписка",
-    "relations_anniversary": "годовщина отношений",
-    "friendship_anniversary": "годовщина дружбы",
-    "move": "переезд",
-    "new_job": "новая работа",
-    "birth_child": "рождение ребёнка",
-    "wedding": "свадьба",
-    "engagement": "помолвка",
-    "proposal": "предложение руки и сердца",
-    "wedding_anniversary": "годовщина свадьбы",
-    "mothers_day": "день матери",
-    "fathers_day": "день отца",
-    "family_day": "день семьи",
-    "valentines_day": "День святого Валентина",
-    "name_day": "день ангела",
-    "new_home": "новоселье",
-}
-
-EMOJI_MAP = {
-    "toast_corporate": "🥂🍻👨‍💼👩‍💼🎉",
-    "toast_wedding": "🥂💍👰🤵💐",
-    "toast_new_year": "🥂🍾🎆🎉",
-    "toast_birthday": "🥂🎂🎈🎁",
-    "toast_farewell": "🥂👋✈️🎉",
-    "toast_cocktail": "🥂🍸🍹",
-    "toast_romantic": "🥂💕🌹",
-    "toast_funny": "🥂😂🎉",
-    "birthday": "🎉🎂🎈🎁🎊",
-    "new_year": "🎄❄️⛄🎁✨",
-    "wedding": "💍👰🤵💐💒",
-    "wedding_anniversary": "💍💕🥂🎉",
-    "graduation": "🎓🎓📚🎉",
-    "car_purchase": "🚗💨🏁",
-    "apartment_purchase": "🏠🔑🎊",
-    "house_purchase": "🏠🏡🎊",
-    "victory": "🏆🎯🎉",
-    "award": "🏆🏅🎉",
-    "sports_success": "🏆⚽🏀🎾",
-    "recovery": "🩹💊✅",
-    "discharge": "🏥✅🩺",
-    "relations_anniversary": "💕🌹🥂",
-    "friendship_anniversary": "🤝💕🎉",
-    "move": "🏠🚚📦",
-    "new_job": "💼👔🎉",
-    "promotion": "💼📈🎉",
-    "retirement": "🎉🏖️👴👵",
-    "project_success": "🚀🎯🎉",
-    "report_submitted": "📋✅🎉",
-    "vacation_start": "✈️🏖️☀️",
-    "vacation_end": "🏠💼📅",
-    "valentines_day": "💕🌹🍫💝",
-    "name_day": "🎂🎉🎈",
-    "new_home": "🏠🎉🎊",
-    "mothers_day": "👩💐💕",
-    "fathers_day": "👨💼🎉",
-    "family_day": "👨‍👩‍👧‍👦💕🎉",
-    "defender_day": "🎖️👨‍✈️🎉",
-    "womens_day": "🌷👩🎉",
-    "teachers_day": "📚👩‍🏫🍎",
-    "doctors_day": "🏥👨‍⚕️💊",
-    "programmers_day": "💻⌨️👨‍💻",
-    "police_day": "🚔👮‍♂️🎖️",
-    "prosecutor_day": "⚖️👨‍💼🎉",
-    "lawyers_day": "⚖️👨‍💼🎉",
-    "company_day": "🏢🎉💼",
-    "birth_child": "👶🍼💕",
-    "engagement": "💍💕👰🤵",
-    "proposal": "💍💕🌹",
-    "xmas": "🎄🎁🎅❄️",
-    "easter": "🐰🥚🌸✝️",
-    "victory_day": "🎉🎖️🇷🇺",
-    "city_day": "🏙️🎊🎉",
-    "independence_day": "🎉🎆🇺🇸",
-    "spring_start": "🌸🌼☀️",
-    "summer_start": "☀️🏖️🏊‍♂️",
-    "autumn_start": "🍁🍃☕",
-    "winter_start": "❄️⛄🎿",
-    "sep_1": "📚🎒🎓",
-    "diploma": "🎓📜🎉",
-    "default": "🎉✨🎊"
-}
+CATEGORY, SUBCATEGORY, STYLE, EMOJIS, NAME, GENERATE, FEEDBACK, SCHEDULE = range(8)
+
+# --- НАЧАЛО: Кнопки ---
+# callback_data: "<версия>.<действие>[.<значение>]", например "1.s.bd_mother".
+# Разбирается один раз и направляется в обработчик по словарю состояния;
+# кнопки старых версий и чужие для текущего состояния отклоняются
+CALLBACK_VERSION = "1"
+
+CB_CATEGORY = "c"
+CB_SUBCATEGORY = "s"
+CB_STYLE = "y"
+CB_EMOJIS = "e"
+CB_DONATE = "d"
+CB_MAIN = "m"
+CB_BACK_CATEGORY = "bc"
+CB_BACK_STYLE = "bs"
+CB_BACK_EMOJIS = "be"
+CB_SKIP_NAME = "sk"
+CB_RESTART = "r"
+CB_MORE = "g"
+CB_SCHEDULE = "sc"
+CB_CANCEL = "x"
+
+def encode_callback(action, value=None):
+    if value is None:
+        return f"{CALLBACK_VERSION}.{action}"
+    return f"{CALLBACK_VERSION}.{action}.{value}"
+
+def decode_callback(data):
+    """(действие, значение) или None для кнопок другой версии и посторонних данных"""
+    if not data:
+        return None
+    parts = data.split(".", 2)
+    if len(parts) < 2 or parts[0] != CALLBACK_VERSION:
+        return None
+    return parts[1], (parts[2] if len(parts) == 3 else None)
+# --- КОНЕЦ: Кнопки ---
+
+# --- НАЧАЛО: Каталог ---
+# Меню и фрагменты промптов хранятся в файле данных и компилируются при запуске
+# в индекс на каждую локаль: все обращения из обработчиков — поиск в словаре
+CATALOG_PATH = os.getenv("CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
+
+class LocaleIndex:
+    """Скомпилированная локаль: метки, фрагменты промптов, смайлики и готовые клавиатуры"""
+    __slots__ = ("code", "language", "language_prepositional", "default_occasion", "ui",
+                 "category_labels", "category_of", "subcategory_labels", "occasions", "emojis",
+                 "default_emojis", "style_ids", "style_labels", "style_descriptions", "main_keyboard",
+                 "subcategory_keyboards", "style_keyboard", "category_style_keyboard",
+                 "emoji_keyboard", "name_keyboard", "generation_keyboard", "donate_keyboard",
+                 "feedback_keyboard", "menu_keyboard", "schedule_keyboard")
+
+    def text(self, key, **kwargs):
+        template = self.ui[key]
+        return template.format(**kwargs) if kwargs else template
+
+class Catalog:
+    __slots__ = ("default_locale", "locales")
+
+    def __init__(self, default_locale, locales):
+        self.default_locale = default_locale
+        self.locales = locales
+
+    def locale(self, language_code=None):
+        """Локаль по language_code пользователя (например, 'en-US'); иначе локаль по умолчанию"""
+        if language_code:
+            index = self.locales.get(language_code[:2].lower())
+            if index is not None:
+                return index
+        return self.locales[self.default_locale]
+
+DONATE_AMOUNTS = (50, 100, 200, 500)
+
+CALLBACK_DATA_LIMIT = 64  # байт, ограничение Telegram
+
+def keyboard(rows):
+    for _, data in rows:
+        if len(data.encode("utf-8")) > CALLBACK_DATA_LIMIT:
+            raise ValueError(f"callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {data}")
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=data)] for text, data in rows])
+
+def compile_locale(code, data, emoji_map):
+    """Собрать индекс локали; строки интернируются, смайлики общие для всех локалей"""
+    intern = sys.intern
+    index = LocaleIndex()
+    index.code = intern(code)
+    index.language = data["language"]
+    index.language_prepositional = data["language_prepositional"]
+    index.default_occasion = data["default_occasion"]
+    index.ui = {intern(key): value for key, value in data["ui"].items()}
+    ui = index.ui
+    default_emojis = index.default_emojis = emoji_map["default"]
+
+    index.category_labels = {intern(item["id"]): item["label"] for item in data["categories"]}
+    index.category_of = {}
+    index.subcategory_labels = {}
+    index.occasions = {}
+    index.emojis = {}
+    index.subcategory_keyboards = {}
+    for category, items in data.get("subcategories", {}).items():
+        category = intern(category)
+        for item in items:
+            key = intern(item["id"])
+            index.category_of[key] = category
+            index.subcategory_labels[key] = item["label"]
+            index.occasions[key] = item["occasion"]
+            # Смайлики подкатегории, иначе категории (например, "birthday" для bd_*), иначе общие
+            index.emojis[key] = emoji_map.get(key) or emoji_map.get(category) or default_emojis
+        index.subcategory_keyboards[category] = keyboard(
+            [(item["label"], encode_callback(CB_SUBCATEGORY, item["id"])) for item in items]
+            + [(ui["back"], encode_callback(CB_MAIN))]
+        )
+    # Категория без подкатегорий сама служит подкатегорией
+    for category in index.category_labels:
+        if category not in index.subcategory_keyboards and category not in ("donate", "feedback"):
+            index.occasions.setdefault(category, index.default_occasion)
+            index.emojis.setdefault(category, emoji_map.get(category) or default_emojis)
+
+    index.style_ids = tuple(intern(item["id"]) for item in data["styles"])
+    index.style_labels = {intern(item["id"]): item["label"] for item in data["styles"]}
+    index.style_descriptions = {intern(item["id"]): item["description"] for item in data["styles"]}
+
+    index.main_keyboard = keyboard(
+        [(label, encode_callback(CB_CATEGORY, key)) for key, label in index.category_labels.items()]
+    )
+    style_rows = [(label, encode_callback(CB_STYLE, key)) for key, label in index.style_labels.items()]
+    index.style_keyboard = keyboard(style_rows + [(ui["back"], encode_callback(CB_BACK_CATEGORY))])
+    index.category_style_keyboard = keyboard(style_rows + [(ui["back"], encode_callback(CB_MAIN))])
+    index.emoji_keyboard = keyboard([
+        (ui["emojis_yes"], encode_callback(CB_EMOJIS, "1")),
+        (ui["emojis_no"], encode_callback(CB_EMOJIS, "0")),
+        (ui["back"], encode_callback(CB_BACK_STYLE)),
+    ])
+    index.name_keyboard = keyboard([
+        (ui["skip"], encode_callback(CB_SKIP_NAME)), (ui["back"], encode_callback(CB_BACK_EMOJIS)),
+    ])
+    index.generation_keyboard = keyboard([
+        (ui["more"], encode_callback(CB_MORE)), (ui["restart"], encode_callback(CB_RESTART)),
+    ])
+    index.donate_keyboard = keyboard(
+        [(f"⭐ {amount} Stars", encode_callback(CB_DONATE, amount)) for amount in DONATE_AMOUNTS]
+        + [(ui["back"], encode_callback(CB_MAIN)), (ui["restart"], encode_callback(CB_RESTART))]
+    )
+    index.feedback_keyboard = keyboard([(ui["back"], encode_callback(CB_MAIN))])
+    index.menu_keyboard = keyboard([(ui["back_to_menu"], encode_callback(CB_MAIN))])
+    index.schedule_keyboard = keyboard([(ui["cancel"], encode_callback(CB_CANCEL))])
+    return index
+
+def load_catalog(path=None):
+    """Прочитать и скомпилировать каталог; при ошибке в данных бросает исключение"""
+    with open(path or CATALOG_PATH, encoding="utf-8") as f:
+        data = json.load(f)
+    emoji_map = {sys.intern(key): value for key, value in data["emojis"].items()}
+    locales = {code: compile_locale(code, locale_data, emoji_map) for code, locale_data in data["locales"].items()}
+    default_locale = data["default_locale"]
+    if default_locale not in locales:
+        raise ValueError(f"Локаль по умолчанию {default_locale} отсутствует в каталоге")
+    return Catalog(default_locale, locales)
+
+CATALOG = load_catalog()
+
+def reload_catalog():
+    """Перечитать каталог без перезапуска; при ошибке остаётся прежний"""
+    global CATALOG
+    try:
+        catalog = load_catalog()
+    except Exception as e:
+        logger.error(f"❌ Не удалось перезагрузить каталог: {e}")
+        return False
+    # Обработчики читают CATALOG один раз за вызов, поэтому замена ссылки атомарна для них
+    CATALOG = catalog
+    logger.info(f"📚 Каталог перезагружен, локали: {', '.join(catalog.locales)}")
+    # Метки подкатегорий входят в инлайн-индекс, поэтому пересобираем и его
+    spawn(refresh_inline_index())
+    return True
+
+def user_locale(user):
+    return CATALOG.locale(getattr(user, "language_code", None))
+
+def store_subcategory(params):
+    """Ключ подкатегории в хранилище: у неосновных локалей свой префикс, чтобы тексты не смешивались"""
+    locale = params.get("locale") or CATALOG.default_locale
+    if locale == CATALOG.default_locale:
+        return params["subcategory_key"]
+    return f"{locale}:{params['subcategory_key']}"
+# --- КОНЕЦ: Каталог ---
 
 REQUEST_LIMIT_PER_MINUTE = 3
 
@@ -480,199 +1765,141 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     log_user(user)
     
-    welcome_text = (
-        "Привет! 👋\n\n"
-        "Я помогу вам быстро и красиво поздравить кого угодно.\n"
-        "Выберите, что вас интересует:"
-    )
-    keyboard = [
-        [InlineKeyboardButton(text, callback_data=key)] for key, text in MAIN_CATEGORIES.items()
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
+    locale = user_locale(user)
     if update.message:
-        await update.message.reply_text(welcome_text, reply_markup=reply_markup)
+        await send_reply(update.message, locale.text("welcome"), reply_markup=locale.main_keyboard)
     elif update.callback_query:
-        await update.callback_query.edit_message_text(welcome_text, reply_markup=reply_markup)
+        await update.callback_query.edit_message_text(locale.text("welcome"), reply_markup=locale.main_keyboard)
     
     return CATEGORY
 
-async def choose_category(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def reject_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Устаревшая или чужая кнопка: только снимаем «часики», состояние диалога не меняется"""
+    inc_metric("stale_callbacks")
+    await update.callback_query.answer(user_locale(update.effective_user).text("stale_button"))
+    return None
+
+def callback_router(routes):
+    """Обработчик состояния: callback_data разбирается один раз и направляется по словарю действий"""
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        decoded = decode_callback(update.callback_query.data)
+        handler = routes.get(decoded[0]) if decoded else None
+        if handler is None:
+            return await reject_callback(update, context)
+        if decoded[1] is None:
+            return await handler(update, context)
+        return await handler(update, context, decoded[1])
+    return route
+
+async def choose_category(update: Update, context: ContextTypes.DEFAULT_TYPE, category_key: str) -> int:
     query = update.callback_query
+    locale = user_locale(update.effective_user)
+    if category_key not in locale.category_labels:
+        return await reject_callback(update, context)
     await query.answer()
-    category_key = query.data
 
     if category_key == "donate":
-        keyboard = [
-            [InlineKeyboardButton("⭐ 50 Stars", callback_data="donate_50")],
-            [InlineKeyboardButton("⭐ 100 Stars", callback_data="donate_100")],
-            [InlineKeyboardButton("⭐ 200 Stars", callback_data="donate_200")],
-            [InlineKeyboardButton("⭐ 500 Stars", callback_data="donate_500")],
-            [InlineKeyboardButton("◀️ Назад", callback_data="back_to_main_category")],
-            [InlineKeyboardButton("🏠 Начать сначала", callback_data="restart_bot")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            "Спасибо, что хотите поддержать проект! 🙏\n\n"
-            "Этот бот не содержит рекламы и разрабатывается на личные средства.\n"
-            "Ваш вклад поможет покрыть расходы на хостинг и дальнейшее развитие.\n\n"
-            "Выберите сумму для поддержки через Telegram Stars:",
-            reply_markup=reply_markup
-        )
+        await query.edit_message_text(locale.text("donate_prompt"), reply_markup=locale.donate_keyboard)
         return CATEGORY
 
     if category_key == "feedback":
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main_category")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Напишите ваше сообщение для обратной связи:", reply_markup=reply_markup)
+        await query.edit_message_text(locale.text("feedback_prompt"), reply_markup=locale.feedback_keyboard)
         return FEEDBACK
 
     context.user_data['main_category'] = category_key
 
-    subcats = SUBCATEGORIES.get(category_key, {})
-    if not subcats:
+    subcategory_keyboard = locale.subcategory_keyboards.get(category_key)
+    if subcategory_keyboard is None:
         context.user_data['subcategory_key'] = category_key
-        keyboard = [
-            [InlineKeyboardButton(text, callback_data=key)] for key, text in STYLES.items()
-        ]
-        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_main_category")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Выберите стиль поздравления:", reply_markup=reply_markup)
+        await query.edit_message_text(locale.text("choose_style"), reply_markup=locale.category_style_keyboard)
         return STYLE
 
-    keyboard = [
-        [InlineKeyboardButton(text, callback_data=key)] for key, text in subcats.items()
-    ]
-    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_main_category")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(f"Выбрана категория: {MAIN_CATEGORIES[category_key]}\nВыберите подкатегорию:", reply_markup=reply_markup)
+    await query.edit_message_text(
+        locale.text("choose_subcategory", category=locale.category_labels[category_key]),
+        reply_markup=subcategory_keyboard
+    )
     return SUBCATEGORY
 
-async def choose_subcategory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def choose_subcategory(update: Update, context: ContextTypes.DEFAULT_TYPE, subcategory_key: str) -> int:
     query = update.callback_query
+    locale = user_locale(update.effective_user)
+    # Подкатегория должна относиться к выбранной категории, иначе кнопка из старого сообщения
+    if locale.category_of.get(subcategory_key) != context.user_data.get('main_category'):
+        return await reject_callback(update, context)
     await query.answer()
-    subcategory_key = query.data
     context.user_data['subcategory_key'] = subcategory_key
 
-    keyboard = [
-        [InlineKeyboardButton(text, callback_data=key)] for key, text in STYLES.items()
-    ]
-    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_category")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Выберите стиль поздравления:", reply_markup=reply_markup)
+    await query.edit_message_text(locale.text("choose_style"), reply_markup=locale.style_keyboard)
     
     return STYLE
 
-async def choose_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def choose_style(update: Update, context: ContextTypes.DEFAULT_TYPE, style_key: str) -> int:
     query = update.callback_query
+    locale = user_locale(update.effective_user)
+    if style_key not in locale.style_labels:
+        return await reject_callback(update, context)
     await query.answer()
-    style_key = query.data
     context.user_data['style'] = style_key
 
-    keyboard = [
-        [InlineKeyboardButton("✅ Да", callback_data="emojis_yes")],
-        [InlineKeyboardButton("❌ Нет", callback_data="emojis_no")],
-        [InlineKeyboardButton("◀️ Назад", callback_data="back_to_style")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    if context.user_data.get('main_category') == 'toast':
-        await query.edit_message_text("Добавить смайлики в тост?", reply_markup=reply_markup)
-    else:
-        await query.edit_message_text("Добавить смайлики?", reply_markup=reply_markup)
-    
+    await ask_emojis(query, context, locale)
     return EMOJIS
 
-async def choose_emojis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def ask_emojis(query, context, locale):
+    text = locale.text("ask_emojis_toast" if context.user_data.get('main_category') == 'toast' else "ask_emojis")
+    await query.edit_message_text(text, reply_markup=locale.emoji_keyboard)
+
+async def choose_emojis(update: Update, context: ContextTypes.DEFAULT_TYPE, emoji_choice: str) -> int:
     query = update.callback_query
+    if emoji_choice not in ("0", "1"):
+        return await reject_callback(update, context)
     await query.answer()
-    emoji_choice = query.data
-    
-    if emoji_choice == "emojis_yes":
-        context.user_data['emojis'] = True
-    elif emoji_choice == "emojis_no":
-        context.user_data['emojis'] = False
-    else:
-        return EMOJIS
+    context.user_data['emojis'] = emoji_choice == "1"
 
-    keyboard = [
-        [InlineKeyboardButton("⏭ Пропустить", callback_data="skip_name")],
-        [InlineKeyboardButton("◀️ Назад", callback_data="back_to_emojis")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Введите имя или уточнение (например, 'для коллеги', 'для мамы'), или нажмите 'Пропустить':", reply_markup=reply_markup)
+    locale = user_locale(update.effective_user)
+    await query.edit_message_text(locale.text("ask_name"), reply_markup=locale.name_keyboard)
     return NAME
 
 async def back_to_main_category(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    welcome_text = (
-        "Привет! 👋\n\n"
-        "Я помогу вам быстро и красиво поздравить кого угодно.\n"
-        "Выберите, что вас интересует:"
-    )
-    keyboard = [
-        [InlineKeyboardButton(text, callback_data=key)] for key, text in MAIN_CATEGORIES.items()
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(welcome_text, reply_markup=reply_markup)
+    locale = user_locale(update.effective_user)
+    await query.edit_message_text(locale.text("welcome"), reply_markup=locale.main_keyboard)
     return CATEGORY
 
 async def back_to_category(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
+    locale = user_locale(update.effective_user)
     category_key = context.user_data.get('main_category')
-    if category_key:
-        subcats = SUBCATEGORIES.get(category_key, {})
-        if subcats:
-            keyboard = [
-                [InlineKeyboardButton(text, callback_data=key)] for key, text in subcats.items()
-            ]
-            keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_main_category")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(f"Выбрана категория: {MAIN_CATEGORIES[category_key]}\nВыберите подкатегорию:", reply_markup=reply_markup)
-            return SUBCATEGORY
-        else:
-            return await back_to_main_category(update, context)
-    else:
+    subcategory_keyboard = locale.subcategory_keyboards.get(category_key)
+    if subcategory_keyboard is None:
         return await back_to_main_category(update, context)
+    await query.edit_message_text(
+        locale.text("choose_subcategory", category=locale.category_labels[category_key]),
+        reply_markup=subcategory_keyboard
+    )
+    return SUBCATEGORY
 
 async def back_to_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
+    locale = user_locale(update.effective_user)
     
-    keyboard = [
-        [InlineKeyboardButton(text, callback_data=key)] for key, text in STYLES.items()
-    ]
-    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_category")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Выберите стиль поздравления:", reply_markup=reply_markup)
+    await query.edit_message_text(locale.text("choose_style"), reply_markup=locale.style_keyboard)
     
     return STYLE
 
 async def back_to_emojis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    
-    keyboard = [
-        [InlineKeyboardButton("✅ Да", callback_data="emojis_yes")],
-        [InlineKeyboardButton("❌ Нет", callback_data="emojis_no")],
-        [InlineKeyboardButton("◀️ Назад", callback_data="back_to_style")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    if context.user_data.get('main_category') == 'toast':
-        await query.edit_message_text("Добавить смайлики в тост?", reply_markup=reply_markup)
-    else:
-        await query.edit_message_text("Добавить смайлики?", reply_markup=reply_markup)
-    
+    await ask_emojis(query, context, user_locale(update.effective_user))
     return EMOJIS
 
 async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     name = update.message.text
     context.user_data['name'] = name
     
-    sent_message = await update.message.reply_text("Генерирую... ⏳")
+    sent_message = await send_reply(update.message, user_locale(update.effective_user).text("generating"))
     context.user_data['generating_message_id'] = sent_message.message_id
     
     await generate_message(update, context)
@@ -682,7 +1909,7 @@ async def skip_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     context.user_data['name'] = None
-    await query.edit_message_text("Генерирую... ⏳")
+    await query.edit_message_text(user_locale(update.effective_user).text("generating"))
     await generate_message_callback(update, context)
     return GENERATE
 
@@ -691,42 +1918,86 @@ async def generate_message_callback(update: Update, context: ContextTypes.DEFAUL
     await generate_message(query, context)
     return GENERATE
 
-async def generate_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if hasattr(update, 'from_user') and hasattr(update, 'message'):
-        user_id = update.from_user.id
-        user = update.from_user
-        message_obj = update.message
-    else:
-        user_id = update.effective_user.id
-        user = update.effective_user
-        message_obj = update.message
-
-    is_limited, reset_time = is_rate_limited(user_id)
-    if is_limited:
-        if reset_time:
-            seconds_left = int(reset_time.total_seconds())
-            minutes_left = seconds_left // 60
-            seconds_remainder = seconds_left % 60
-            
-            log_rate_limit(user, seconds_left)
-            
-            if minutes_left > 0:
-                await message_obj.reply_text(f"⏳ Превышен лимит запросов.\nПопробуйте через {minutes_left} мин {seconds_remainder} сек.")
-            else:
-                await message_obj.reply_text(f"⏳ Превышен лимит запросов.\nПопробуйте через {seconds_left} сек.")
-        else:
-            await message_obj.reply_text("⏳ Превышен лимит запросов. Попробуйте позже.")
-        return GENERATE
-
-    subcategory_key = context.user_data.get('subcategory_key')
-    name = context.user_data.get('name')
-    emojis = context.user_data.get('emojis', False)
-    style = context.user_data.get('style', 'standard')
+def parse_variants(message_text):
+    """Разбить ответ модели на отдельные варианты без исходной нумерации"""
+    variants = []
+    # ИСПРАВЛЕНО: Разбиваем по двойному переносу строки
+    for part in message_text.split("\n\n"):
+        clean_part = part.strip()
+        
+        # Убираем старую нумерацию из ответа GPT
+        if clean_part.startswith(("1.", "2.", "3.", "1)", "2)", "3)")):
+            clean_part = clean_part[2:].strip()
+        
+        if clean_part:
+            variants.append(clean_part)
+    return variants
+
+OPENAI_CLIENT = None
+
+def get_openai_client():
+    """Общий клиент OpenAI: модуль импортируется и клиент создаётся при первом обращении"""
+    global OPENAI_CLIENT
+    if OPENAI_CLIENT is None:
+        import openai
+        OPENAI_CLIENT = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
+    return OPENAI_CLIENT
+
+async def request_variants(system_prompt, prompt, mode=OPENAI_NORMAL):
+    """Запросить у OpenAI варианты поздравления"""
+    client = get_openai_client()
+    degraded = mode == OPENAI_DEGRADED
+    started = time.monotonic()
+    ok = False
+    try:
+        with trace_span("openai", model="gpt-4o-mini", mode=mode):
+            response = await client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=DEGRADED_MAX_TOKENS if degraded else DEFAULT_MAX_TOKENS,
+                temperature=0.8,
+                timeout=DEGRADED_OPENAI_TIMEOUT if degraded else OPENAI_TIMEOUT
+            )
+        ok = True
+    finally:
+        record_openai_result(mode, time.monotonic() - started, ok)
+    with trace_span("parse"):
+        return parse_variants(response.choices[0].message.content)
+
+async def request_fresh_variants(user_id, system_prompt, prompt, mode=OPENAI_NORMAL):
+    """Запросить варианты у OpenAI, заменив почти повторяющие уже показанные"""
+    variants = await request_variants(system_prompt, prompt, mode)
+    fresh, duplicates = filter_near_duplicates(user_id, variants)
+    
+    # Догенерируем только те варианты, которые почти повторяют уже показанные;
+    # в деградированном режиме лишних запросов не делаем
+    retries = NEAR_DUPLICATE_RETRIES if mode == OPENAI_NORMAL else 0
+    while duplicates and retries > 0:
+        retries -= 1
+        logger.info("🔁 Повторяющихся вариантов для %s: %s, догенерирую", user_id, len(duplicates),
+                    extra={"event": "near_duplicates", "stage": "openai", "user_id": user_id})
+        extra = await request_variants(system_prompt, prompt)
+        # Уже принятые варианты идут первыми и проходят фильтр без изменений,
+        # поэтому новые кандидаты сверяются и с историей, и с ними
+        extra_fresh, _ = filter_near_duplicates(user_id, fresh + extra)
+        replacements = extra_fresh[len(fresh):][:len(duplicates)]
+        fresh.extend(replacements)
+        duplicates = duplicates[len(replacements):]
+    
+    # Если новых вариантов не нашлось совсем, лучше показать повторы, чем ничего
+    return fresh or duplicates, fresh
 
-    category_internal = CATEGORY_INTERNAL.get(subcategory_key, "праздник")
-    style_description = STYLE_DESCRIPTIONS.get(style, "стандартное")
+def build_prompts(subcategory_key, style, emojis, name, locale=None):
+    """Собрать системный и пользовательский промпты для OpenAI"""
+    index = CATALOG.locale(locale)
+    category_internal = index.occasions.get(subcategory_key, index.default_occasion)
+    style_description = index.style_descriptions.get(style, index.style_descriptions["standard"])
+    language = index.language
 
-    emoji_string = EMOJI_MAP.get(subcategory_key, EMOJI_MAP.get(category_internal.split()[0], EMOJI_MAP["default"])) if emojis else ""
+    emoji_string = index.emojis.get(subcategory_key, index.default_emojis) if emojis else ""
     emoji_instruction = f"Разрешено использовать следующие смайлики: {emoji_string}. Распредели их равномерно по всем трём вариантам, от 20 до 35 штук в каждом. Смайлики должны быть в разных местах текста: в начале, в середине, в конце. Чередуй их разнообразно, чтобы текст был живым и не однообразным." if emojis else "Не использовать смайлы."
 
     name_part = f"поздравь {name}" if name else "поздравление для друга"
@@ -737,7 +2008,7 @@ async def generate_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 Стиль: {style_description}.
 {emoji_instruction}
 Адресат: {name_part}.
-Язык: русский.
+Язык: {language}.
 Требования:
 - Это должны быть **реальные**, **существующие** тосты, **не придуманные**.
 - Соблюдай выбранный стиль: {style_description}.
@@ -749,14 +2020,14 @@ async def generate_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 - Не использовать "ChatGPT", "OpenAI" или подобные обращения.
 - Всегда возвращай 3 варианта в виде пронумерованного списка.
 """
-        system_prompt = f"Ты — профессиональный автор тостов. Пиши на русском языке в стиле: {style_description}. Возвращай 3 популярных, существующих тоста в виде пронумерованного списка. Используй короткие тире (-). Если разрешены смайлики, распредели их равномерно по всем трём вариантам, от 20 до 35 штук в каждом, размещая их в разных частях текста для разнообразия."
+        system_prompt = f"Ты — профессиональный автор тостов. Пиши на {index.language_prepositional} языке в стиле: {style_description}. Возвращай 3 популярных, существующих тоста в виде пронумерованного списка. Используй короткие тире (-). Если разрешены смайлики, распредели их равномерно по всем трём вариантам, от 20 до 35 штук в каждом, размещая их в разных частях текста для разнообразия."
     else:
         prompt = f"""
 Создай 3 разных {category_internal} в прозе или стихе.
 Стиль: {style_description}.
 {emoji_instruction}
 Адресат: {name_part}.
-Язык: русский.
+Язык: {language}.
 Требования:
 - Соблюдай выбранный стиль: {style_description}.
 - Без повторов фраз между вариантами.
@@ -767,89 +2038,216 @@ async def generate_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 - Не использовать "ChatGPT", "OpenAI" или подобные обращения.
 - Всегда возвращай 3 варианта в виде пронумерованного списка.
 """
-        system_prompt = f"Ты — профессиональный автор поздравлений и тостов. Пиши на русском языке в стиле: {style_description}. Не используй восклицательные знаки подряд (макс. 1), избегай шаблонов 'желаю счастья, здоровья'. Всегда возвращай 3 варианта в виде пронумерованного списка. Используй короткие тире (-). Если разрешены смайлики, распредели их равномерно по всем трём вариантам, от 20 до 35 штук в каждом, размещая их в разных частях текста для разнообразия."
+        system_prompt = f"Ты — профессиональный автор поздравлений и тостов. Пиши на {index.language_prepositional} языке в стиле: {style_description}. Не используй восклицательные знаки подряд (макс. 1), избегай шаблонов 'желаю счастья, здоровья'. Всегда возвращай 3 варианта в виде пронумерованного списка. Используй короткие тире (-). Если разрешены смайлики, распредели их равномерно по всем трём вариантам, от 20 до 35 штук в каждом, размещая их в разных частях текста для разнообразия."
+    return system_prompt, prompt
+
+def generation_params(user_data, locale):
+    """Параметры генерации из состояния диалога (сериализуемые, чтобы их можно было сохранить)"""
+    return {
+        "main_category": user_data.get('main_category', 'unknown'),
+        "subcategory_key": user_data.get('subcategory_key'),
+        "style": user_data.get('style', 'standard'),
+        "emojis": user_data.get('emojis', False),
+        "name": user_data.get('name'),
+        "locale": locale,
+    }
+
+async def produce_variants(user_id, params):
+    """Получить варианты: сначала из хранилища, затем через OpenAI; второй элемент — True, если при деградации отданы готовые варианты"""
+    subcategory_key = params["subcategory_key"]
+    style = params["style"]
+    emojis = params["emojis"]
+    name = params["name"]
+    stored_key = store_subcategory(params)
+
+    with trace_span("store_lookup", personalized=bool(name)) as span:
+        if name:
+            variants = pick_personalized_variants(user_id, stored_key, style, emojis, name) if stored_key == subcategory_key else []
+        else:
+            variants = pick_instant_variants(user_id, stored_key, style, emojis)
+        span.set_attribute("hit", bool(variants))
+    if variants:
+        logger.info("⚡ Мгновенные варианты из хранилища для %s: %s/%s", user_id, subcategory_key, style,
+                    extra={"event": "instant_variants", "stage": "store", "user_id": user_id})
+        return variants, False
+
+    mode = openai_mode()
+    set_span_attribute("openai_mode", mode)
+    if mode == OPENAI_DEGRADED:
+        inc_metric("degraded_generations")
+        with trace_span("degraded_lookup"):
+            variants = pick_degraded_variants(user_id, params)
+        if variants:
+            return variants, True
+        # Короткий запрос и без смайликов: так ответ приходит заметно быстрее
+        emojis = False
+
+    with trace_span("prompt"):
+        system_prompt, prompt = build_prompts(subcategory_key, style, emojis, name, params.get("locale"))
+    variants, fresh = await request_fresh_variants(user_id, system_prompt, prompt, mode)
+    # Поздравления с именем в хранилище не кладём: их нельзя показать другим
+    if not name:
+        with trace_span("store_save"):
+            save_greetings(user_id, stored_key, style, emojis, fresh)
+    # Короткий запрос — тоже генерация, а не готовые варианты из хранилища: уведомление не нужно
+    return variants, False
+
+async def generate_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    with trace_span("generation"):
+        return await run_generation(update, context)
+
+async def run_generation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if hasattr(update, 'from_user') and hasattr(update, 'message'):
+        user_id = update.from_user.id
+        user = update.from_user
+        message_obj = update.message
+    else:
+        user_id = update.effective_user.id
+        user = update.effective_user
+        message_obj = update.message
+
+    locale = user_locale(user)
+    set_span_attribute("user_id", user_id)
+    with trace_span("rate_limit"):
+        is_limited, reset_time = is_rate_limited(user_id)
+    if is_limited:
+        if reset_time:
+            seconds_left = int(reset_time.total_seconds())
+            minutes_left = seconds_left // 60
+            seconds_remainder = seconds_left % 60
+            
+            log_rate_limit(user, seconds_left)
+            
+            if minutes_left > 0:
+                await send_reply(message_obj, locale.text("rate_limited_minutes", minutes=minutes_left, seconds=seconds_remainder))
+            else:
+                await send_reply(message_obj, locale.text("rate_limited_seconds", seconds=seconds_left))
+        else:
+            await send_reply(message_obj, locale.text("rate_limited"))
+        return GENERATE
+
+    params = generation_params(context.user_data, locale.code)
+
+    if not ACCEPTING_GENERATIONS:
+        defer_generation(message_obj.chat_id, user, params)
+        await send_reply(message_obj, locale.text("restart_notice"))
+        return GENERATE
 
     generation_success = False
+    started = time.perf_counter()
     try:
-        client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
-        response = await client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=2500,
-            temperature=0.8
-        )
-
-        message_text = response.choices[0].message.content
-        
-        # ИСПРАВЛЕНО: Разбиваем по двойному переносу строки и отправляем с нумерацией
-        parts = message_text.split("\n\n")
-        variant_number = 1
+        set_span_attribute("subcategory", params["subcategory_key"])
+        set_span_attribute("style", params["style"])
+        variants_to_send, degraded = await run_tracked_generation(message_obj.chat_id, user, params)
+        if degraded:
+            await send_reply(message_obj, locale.text("degraded_notice"))
         
-        for part in parts:
-            if part.strip():
-                clean_part = part.strip()
-                
-                # Убираем старую нумерацию из ответа GPT
-                if clean_part.startswith(("1.", "2.", "3.", "1)", "2)", "3)")):
-                    clean_part = clean_part[2:].strip()
-                
-                # Добавляем свою красивую нумерацию
-                if clean_part:
-                    formatted_message = f"**Вариант {variant_number}:**\n\n{clean_part}"
-                    await message_obj.reply_text(formatted_message, parse_mode="Markdown")
-                    variant_number += 1
+        # Варианты запоминаем, чтобы кнопка «Запланировать» ссылалась на них по номеру
+        batch = context.user_data.get('variants_batch', 0) + 1
+        context.user_data['variants_batch'] = batch
+        context.user_data['variants'] = variants_to_send
+        with trace_span("telegram_send", variants=len(variants_to_send)):
+            for variant_number, variant in enumerate(variants_to_send, start=1):
+                formatted_message = f"**{locale.text('variant', number=variant_number)}:**\n\n{variant}"
+                schedule_markup = keyboard([(locale.text("schedule"), encode_callback(CB_SCHEDULE, f"{batch}:{variant_number - 1}"))])
+                await send_reply(message_obj, formatted_message, parse_mode="Markdown", reply_markup=schedule_markup)
         
+        remember_variants(user_id, variants_to_send)
         generation_success = True
-
+        logger.info("✍️ Отправлено вариантов: %s", len(variants_to_send), extra={
+            "event": "generation", "stage": "generation", "user_id": user_id,
+            "latency_ms": round((time.perf_counter() - started) * 1000),
+        })
+
+    except GenerationDeferred:
+        # Генерация сохранена и будет выполнена после перезапуска
+        await send_reply(message_obj, locale.text("restart_notice"))
+        return GENERATE
     except Exception as e:
         logger.error(f"Ошибка при генерации: {e}")
-        await message_obj.reply_text("❌ Ошибка при генерации поздравления. Попробуйте ещё раз.")
+        await send_reply(message_obj, locale.text("generation_error"))
     
-    log_generation(
-        user=user,
-        category=context.user_data.get('main_category', 'unknown'),
-        subcategory=subcategory_key,
-        style=style,
-        emojis=emojis,
-        name_provided=bool(name),
-        success=generation_success
-    )
+    with trace_span("log_generation"):
+        log_generation(
+            user=user,
+            category=params["main_category"],
+            subcategory=params["subcategory_key"],
+            style=params["style"],
+            emojis=params["emojis"],
+            name_provided=bool(params["name"]),
+            success=generation_success
+        )
 
-    keyboard = [
-        [InlineKeyboardButton("🔄 Ещё варианты", callback_data="generate_again")],
-        [InlineKeyboardButton("🏠 Начать сначала", callback_data="restart_bot")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await message_obj.reply_text("Дополнительные действия:", reply_markup=reply_markup)
+    await send_reply(message_obj, locale.text("actions"), reply_markup=locale.generation_keyboard)
     
     return GENERATE
 
 async def generate_again(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Генерирую новые... ⏳")
+    await query.edit_message_text(user_locale(update.effective_user).text("generating_again"))
     await generate_message(query, context)
     return GENERATE
 
+async def schedule_variant(update: Update, context: ContextTypes.DEFAULT_TYPE, value: str) -> int:
+    query = update.callback_query
+    batch, _, number = value.partition(":")
+    variants = context.user_data.get('variants') or []
+    # Кнопка под вариантом из прошлой генерации уже ни на что не указывает
+    if batch != str(context.user_data.get('variants_batch')) or not number.isdigit() or int(number) >= len(variants):
+        return await reject_callback(update, context)
+    await query.answer()
+    context.user_data['schedule_text'] = variants[int(number)]
+    locale = user_locale(update.effective_user)
+    await send_reply(query.message, locale.text("ask_schedule_date", timezone=SCHEDULE_TIMEZONE),
+                     reply_markup=locale.schedule_keyboard)
+    return SCHEDULE
+
+async def handle_schedule_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    locale = user_locale(update.effective_user)
+    text = context.user_data.get('schedule_text')
+    if not text:
+        await send_reply(update.message, locale.text("schedule_expired"), reply_markup=locale.generation_keyboard)
+        return GENERATE
+    now = datetime.now(SCHEDULE_TZ)
+    due = parse_schedule_date(update.message.text, now)
+    if due is None:
+        await send_reply(update.message, locale.text("schedule_bad_date"), reply_markup=locale.schedule_keyboard)
+        return SCHEDULE
+    if due <= now:
+        await send_reply(update.message, locale.text("schedule_past"), reply_markup=locale.schedule_keyboard)
+        return SCHEDULE
+    if due - now > SCHEDULE_MAX_AHEAD:
+        await send_reply(update.message, locale.text("schedule_too_far"), reply_markup=locale.schedule_keyboard)
+        return SCHEDULE
+
+    context.user_data.pop('schedule_text', None)
+    if add_scheduled_greeting(update.effective_user.id, update.message.chat_id, int(due.timestamp()), text) is None:
+        await send_reply(update.message, locale.text("schedule_limit", limit=SCHEDULE_MAX_PER_USER),
+                         reply_markup=locale.generation_keyboard)
+        return GENERATE
+    logger.info("📅 Запланировано поздравление на %s", due.isoformat(),
+                extra={"event": "scheduled", "user_id": update.effective_user.id})
+    await send_reply(update.message, locale.text("scheduled_ok", date=due.strftime("%d.%m.%Y %H:%M")),
+                     reply_markup=locale.generation_keyboard)
+    return GENERATE
+
+async def cancel_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    context.user_data.pop('schedule_text', None)
+    locale = user_locale(update.effective_user)
+    await query.edit_message_text(locale.text("actions"), reply_markup=locale.generation_keyboard)
+    return GENERATE
+
 async def restart_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     
     context.user_data.clear()
     
-    welcome_text = (
-        "Привет! 👋\n\n"
-        "Я помогу вам быстро и красиво поздравить кого угодно.\n"
-        "Выберите, что вас интересует:"
-    )
-    keyboard = [
-        [InlineKeyboardButton(text, callback_data=key)] for key, text in MAIN_CATEGORIES.items()
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(welcome_text, reply_markup=reply_markup)
+    locale = user_locale(update.effective_user)
+    await query.edit_message_text(locale.text("welcome"), reply_markup=locale.main_keyboard)
     return CATEGORY
 
 async def handle_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -858,72 +2256,47 @@ async def handle_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     log_feedback(user, feedback_text)
     
-    logger.info(f"📩 Получена обратная связь от {user.id} (@{user.username}): {feedback_text}")
-
-    admin_id = os.getenv("ADMIN_TELEGRAM_ID")
-    
-    if admin_id:
-        try:
-            await context.bot.send_message(
-                chat_id=int(admin_id), 
-                text=f"📩 **Обратная связь**\n\n"
-                     f"От: @{user.username if user.username else 'без username'}\n"
-                     f"ID: `{user.id}`\n"
-                     f"Имя: {user.first_name} {user.last_name if user.last_name else ''}\n\n"
-                     f"Сообщение:\n{feedback_text}",
-                parse_mode="Markdown"
-            )
-            await update.message.reply_text("Спасибо за ваше сообщение! Мы его получили. ✅")
-            logger.info(f"✅ Обратная связь успешно отправлена админу {admin_id}")
-        except ValueError as ve:
-            logger.error(f"❌ ADMIN_TELEGRAM_ID имеет некорректное значение: {admin_id}. Ошибка: {ve}")
-            await update.message.reply_text("Спасибо за ваше сообщение! ✅")
-        except Exception as e:
-            logger.error(f"❌ Ошибка при отправке обратной связи админу: {e}")
-            await update.message.reply_text("Спасибо за ваше сообщение! ✅")
-    else:
-        logger.warning(f"⚠️ ADMIN_TELEGRAM_ID не установлен. Обратная связь не отправлена: {feedback_text}")
-        await update.message.reply_text("Спасибо за ваше сообщение! Мы его получили. ✅")
-
-    keyboard = [[InlineKeyboardButton("🏠 Вернуться в меню", callback_data="back_to_main_category")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Хотите вернуться в меню?", reply_markup=reply_markup)
+    logger.info("📩 Получена обратная связь от %s (@%s): %s", user.id, user.username, feedback_text,
+                extra={"event": "feedback", "user_id": user.id})
+
+    sender = f"От: @{user.username if user.username else 'без username'}\n"
+    details = f"Имя: {user.first_name} {user.last_name if user.last_name else ''}\n\nСообщение:\n{feedback_text}"
+    notify_admin(
+        context.bot,
+        "feedback",
+        f"📩 **Обратная связь**\n\n{sender}ID: `{user.id}`\n{details}",
+        parse_mode="Markdown",
+        plain_text=f"📩 Обратная связь\n\n{sender}ID: {user.id}\n{details}"
+    )
+    locale = user_locale(user)
+    await send_reply(update.message, locale.text("feedback_thanks"))
+    await send_reply(update.message, locale.text("menu_prompt"), reply_markup=locale.menu_keyboard)
     
     return CATEGORY
 
-async def handle_donate_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_donate_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, amount: str):
     query = update.callback_query
+    if not amount.isdigit() or int(amount) not in DONATE_AMOUNTS:
+        return await reject_callback(update, context)
     await query.answer()
     
-    amount_map = {
-        "donate_50": 50,
-        "donate_100": 100,
-        "donate_200": 200,
-        "donate_500": 500,
-    }
-    
-    stars_amount = amount_map.get(query.data, 50)
+    stars_amount = int(amount)
+    locale = user_locale(update.effective_user)
     
     try:
         await context.bot.send_invoice(
             chat_id=query.from_user.id,
-            title=f"Поддержка проекта",
-            description=f"Спасибо за вашу поддержку! Вы помогаете развитию бота.",
+            title=locale.text("invoice_title"),
+            description=locale.text("invoice_description"),
             payload=f"donate_{stars_amount}_stars",
             provider_token="",
             currency="XTR",
-            prices=[LabeledPrice("Поддержка проекта", stars_amount)],
-        )
-        await query.edit_message_text(
-            f"Отправлен счёт на {stars_amount} ⭐ Stars.\n"
-            "Проверьте сообщение с инвойсом выше. 👆"
+            prices=[LabeledPrice(locale.text("invoice_title"), stars_amount)],
         )
+        await query.edit_message_text(locale.text("invoice_sent", amount=stars_amount))
     except Exception as e:
         logger.error(f"Ошибка при отправке инвойса: {e}")
-        await query.edit_message_text(
-            "❌ Извините, произошла ошибка при создании платежа.\n"
-            "Попробуйте позже или свяжитесь с разработчиком через обратную связь."
-        )
+        await query.edit_message_text(locale.text("invoice_error"))
 
 async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.pre_checkout_query
@@ -933,28 +2306,30 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
     user = update.effective_user
     payment = update.message.successful_payment
     
-    log_donation(user, payment.total_amount, payment.invoice_payload)
+    if not await record_payment(context.bot, user, payment):
+        return
     
-    logger.info(f"💰 Donation received from {user.id} (@{user.username}): {payment.total_amount} Stars")
+    logger.info("💰 Donation received from %s (@%s): %s Stars", user.id, user.username, payment.total_amount,
+                extra={"event": "donation", "user_id": user.id})
     
+    await send_reply(update.message, user_locale(user).text("donation_thanks"))
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сводка метрик для администратора"""
     admin_id = os.getenv("ADMIN_TELEGRAM_ID")
-    if admin_id:
-        try:
-            await context.bot.send_message(
-                chat_id=int(admin_id),
-                text=f"💰 Получен донат!\n"
-                     f"От: @{user.username} (ID: {user.id})\n"
-                     f"Сумма: {payment.total_amount} ⭐ Stars\n"
-                     f"Payload: {payment.invoice_payload}"
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при уведомлении админа о донате: {e}")
-    
-    await update.message.reply_text(
-        "🎉 Огромное спасибо за вашу поддержку!\n\n"
-        "Ваш вклад очень важен для развития проекта. ❤️\n\n"
-        "Если у вас есть идеи или пожелания — пишите в обратную связь!"
-    )
+    if not admin_id or str(update.effective_user.id) != admin_id:
+        return
+    await send_reply(update.message, f"📈 Метрики\n\n{format_metrics()}")
+
+async def reload_catalog_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Перечитать каталог меню и промптов без перезапуска"""
+    admin_id = os.getenv("ADMIN_TELEGRAM_ID")
+    if not admin_id or str(update.effective_user.id) != admin_id:
+        return
+    if reload_catalog():
+        await send_reply(update.message, f"📚 Каталог перезагружен: {', '.join(CATALOG.locales)}")
+    else:
+        await send_reply(update.message, "❌ Каталог не перезагружен, подробности в логах")
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error(f"Exception while handling an update: {context.error}")
@@ -962,73 +2337,465 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     if isinstance(context.error, Conflict):
         logger.critical("⚠️ CONFLICT ERROR: Запущено несколько экземпляров бота! Остановите старые экземпляры.")
 
-def main():
-    global GOOGLE_SHEET, GOOGLE_SHEET_ID
+# --- НАЧАЛО: Инлайн-режим ---
+# "@bot мама день рождения" в любом чате: поиск по заранее собранному индексу
+# из меток каталога и сохранённых вариантов, без обращения к OpenAI
+INLINE_RESULTS_LIMIT = 10
+INLINE_PER_SUBCATEGORY = 20   # вариантов каждой подкатегории в индексе
+INLINE_MIN_TERM = 3           # более короткие слова (предлоги, союзы) не индексируются
+INLINE_DEBOUNCE = 0.3         # сек: запросы приходят на каждое нажатие клавиши
+INLINE_CACHE_TIME = 300       # сек: столько Telegram кэширует ответ у себя
+INLINE_CACHE_SIZE = 5000      # ответов в нашем кэше на каждую локаль
+INLINE_INDEX_REFRESH = 600
+INLINE_DESCRIPTION_LENGTH = 100
+INLINE_WORD_RE = re.compile(r"\w+")
+
+class InlineIndex:
+    """Индекс одной локали: префиксы слов -> номера вариантов; номера идут по убыванию качества"""
+    __slots__ = ("docs", "postings", "cache")
+
+    def __init__(self):
+        self.docs = []
+        self.postings = {}
+        self.cache = {}
+
+    def add(self, greeting_id, title, text, terms):
+        doc = len(self.docs)
+        self.docs.append((greeting_id, title, text))
+        # Все префиксы слова: так находятся и недописанные слова, и другие падежи («мама» — «мамы»)
+        for key in {term[:length] for term in terms for length in range(INLINE_MIN_TERM, len(term) + 1)}:
+            self.postings.setdefault(key, []).append(doc)
+
+    def search(self, query):
+        keys = {inline_query_key(term) for term in inline_terms(query)}
+        if not keys:
+            return list(range(min(INLINE_RESULTS_LIMIT, len(self.docs))))
+        scores = defaultdict(int)
+        for key in keys:
+            for doc in self.postings.get(key, ()):
+                scores[doc] += 1
+        return heapq.nsmallest(INLINE_RESULTS_LIMIT, scores, key=lambda doc: (-scores[doc], doc))
+
+INLINE_INDEXES = {}
+INLINE_LATEST = {}  # user_id -> id последнего inline-запроса пользователя
+
+def inline_terms(text):
+    return {word for word in INLINE_WORD_RE.findall(text.lower().replace("ё", "е")) if len(word) >= INLINE_MIN_TERM}
+
+def inline_query_key(term):
+    # Последняя буква чаще всего окончание, поэтому ищем по префиксу без неё
+    return term[:max(INLINE_MIN_TERM, len(term) - 1)]
+
+def load_inline_greetings(catalog):
+    """Лучшие по оценке варианты каждой подкатегории; отдельное соединение только для чтения"""
+    subcategories = set()
+    for code, locale in catalog.locales.items():
+        prefix = "" if code == catalog.default_locale else f"{code}:"
+        subcategories.update(f"{prefix}{key}" for key in locale.occasions)
+    try:
+        conn = sqlite3.connect(f"file:{GREETING_STORE_PATH}?mode=ro", uri=True)
+    except sqlite3.OperationalError:
+        return []
+    try:
+        rows = []
+        for subcategory in subcategories:
+            rows.extend(conn.execute(
+                "SELECT id, subcategory, text, quality FROM greetings WHERE subcategory = ? ORDER BY quality DESC LIMIT ?",
+                (subcategory, INLINE_PER_SUBCATEGORY)
+            ))
+        return rows
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        conn.close()
+
+def build_inline_indexes(catalog):
+    indexes = {code: InlineIndex() for code in catalog.locales}
+    label_terms = {}
+    rows = sorted(load_inline_greetings(catalog), key=operator.itemgetter(3), reverse=True)
+    for greeting_id, subcategory, text, _ in rows:
+        code, _, key = subcategory.rpartition(":")
+        locale = catalog.locales.get(code or catalog.default_locale)
+        if locale is None:
+            continue
+        title = locale.subcategory_labels.get(key) or locale.category_labels.get(key, "")
+        terms = label_terms.get((locale.code, key))
+        if terms is None:
+            category = locale.category_of.get(key, key)
+            terms = label_terms[(locale.code, key)] = inline_terms(
+                f"{title} {locale.occasions.get(key, '')} {locale.category_labels.get(category, '')}"
+            )
+        indexes[locale.code].add(greeting_id, title, text, terms | inline_terms(text))
+    return indexes
+
+async def refresh_inline_index() -> None:
+    global INLINE_INDEXES
+    started = time.perf_counter()
+    indexes = await asyncio.to_thread(build_inline_indexes, CATALOG)
+    INLINE_INDEXES = indexes
+    observe_metric("inline_index_build", time.perf_counter() - started)
+    logger.info("🔎 Инлайн-индекс собран: %s", ", ".join(f"{code}={len(index.docs)}" for code, index in indexes.items()),
+                extra={"event": "inline_index", "latency_ms": round((time.perf_counter() - started) * 1000)})
+
+async def inline_index_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await refresh_inline_index()
+
+def schedule_inline_index(application):
+    application.job_queue.run_repeating(inline_index_job, interval=INLINE_INDEX_REFRESH, first=0, name="inline_index")
+
+def inline_results(locale, query):
+    """Готовые результаты из кэша индекса; кэш сбрасывается вместе с пересборкой индекса"""
+    index = INLINE_INDEXES.get(locale.code)
+    if index is None:
+        return []
+    cache_key = " ".join(sorted(inline_terms(query)))
+    results = index.cache.get(cache_key)
+    if results is not None:
+        inc_metric("inline_cache_hits")
+        return results
+    results = []
+    for doc in index.search(query):
+        greeting_id, title, text = index.docs[doc]
+        results.append(InlineQueryResultArticle(
+            id=str(greeting_id),
+            title=title,
+            description=" ".join(text.split())[:INLINE_DESCRIPTION_LENGTH],
+            input_message_content=InputTextMessageContent(text),
+        ))
+    if len(index.cache) >= INLINE_CACHE_SIZE:
+        del index.cache[next(iter(index.cache))]
+    index.cache[cache_key] = results
+    return results
+
+async def answer_inline_query(inline_query):
+    """Ответить, если за время ожидания пользователь не напечатал ещё что-нибудь"""
+    user_id = inline_query.from_user.id
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    if INLINE_LATEST.get(user_id) != inline_query.id:
+        inc_metric("inline_debounced")
+        return
+    del INLINE_LATEST[user_id]
+    locale = user_locale(inline_query.from_user)
+    started = time.perf_counter()
+    results = inline_results(locale, inline_query.query)
+    observe_metric("inline_search", time.perf_counter() - started)
+    try:
+        await inline_query.answer(
+            results,
+            cache_time=INLINE_CACHE_TIME,
+            # Результаты и кнопка зависят от локали пользователя: общий кэш Telegram по строке запроса
+            # отдал бы их другим пользователям
+            is_personal=True,
+            button=InlineQueryResultsButton(text=locale.text("inline_open_bot"), start_parameter="inline"),
+        )
+    except BadRequest as e:
+        # Запрос устарел, пока мы ждали: Telegram принимает ответ только несколько секунд
+        logger.warning("⚠️ Inline-ответ не принят: %s", e, extra={"event": "inline_rejected", "user_id": user_id})
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    inline_query = update.inline_query
+    INLINE_LATEST[inline_query.from_user.id] = inline_query.id
+    # Ожидание не должно задерживать остальные апдейты, поэтому отвечаем из фоновой задачи
+    spawn(answer_inline_query(inline_query))
+# --- КОНЕЦ: Инлайн-режим ---
+
+# --- НАЧАЛО: Жизненный цикл ---
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))   # Ожидание текущих генераций, сек
+ANALYTICS_FLUSH_TIMEOUT = float(os.getenv("ANALYTICS_FLUSH_TIMEOUT", "8"))  # Ожидание записи аналитики, сек
+PENDING_JOBS_PATH = os.getenv("PENDING_JOBS_PATH", "pending_jobs.json")
+
+ACCEPTING_GENERATIONS = True
+INFLIGHT_GENERATIONS = {}   # Задача генерации → описание задания для возобновления
+PENDING_GENERATIONS = []    # Задания, которые нужно выполнить после перезапуска
+RESUME_QUEUE = deque()      # Задания прошлого запуска, которые ещё не начали выполняться
+DRAIN_TASK = None
+SHUTDOWN_DEADLINE = None    # time.monotonic(), к которому остановка должна завершить дренаж
+BACKGROUND_TASKS = set()    # Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+METRICS_TASK = None         # Бесконечный цикл метрик: его не ждём при остановке
+
+class GenerationDeferred(Exception):
+    """Генерация прервана остановкой бота и отложена до перезапуска"""
+
+def spawn(coro):
+    """Запустить фоновую задачу вне обработки апдейта"""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+def generation_job(chat_id, user, params):
+    return {"chat_id": chat_id, "user": user_snapshot(user), "params": params}
+
+def defer_generation(chat_id, user, params):
+    """Отложить генерацию до перезапуска"""
+    PENDING_GENERATIONS.append(generation_job(chat_id, user, params))
+    logger.info(f"⏸ Генерация для {user.id} отложена до перезапуска")
+
+async def run_tracked_generation(chat_id, user, params):
+    """Выполнить генерацию так, чтобы остановка бота могла её дождаться или отложить"""
+    task = asyncio.create_task(produce_variants(user.id, params))
+    INFLIGHT_GENERATIONS[task] = generation_job(chat_id, user, params)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if task.cancelled() and not ACCEPTING_GENERATIONS:
+            raise GenerationDeferred() from None
+        raise
+    finally:
+        INFLIGHT_GENERATIONS.pop(task, None)
+
+async def drain_generations(timeout):
+    """Дождаться текущих генераций; незавершённые к сроку отменить и отложить"""
+    if INFLIGHT_GENERATIONS:
+        logger.info(f"⏳ Ожидаю завершения генераций: {len(INFLIGHT_GENERATIONS)}")
+        await asyncio.wait(set(INFLIGHT_GENERATIONS), timeout=timeout)
+    for task, job in list(INFLIGHT_GENERATIONS.items()):
+        if not task.done():
+            PENDING_GENERATIONS.append(job)
+            task.cancel()
+    if PENDING_GENERATIONS:
+        logger.warning(f"⚠️ Отложено генераций до перезапуска: {len(PENDING_GENERATIONS)}")
+
+async def drain_background_tasks(timeout):
+    """Дождаться фоновых отправок (уведомления, платежи, доставки, инлайн); оставшиеся к сроку отменить"""
+    tasks = {task for task in BACKGROUND_TASKS if not task.done()}
+    if not tasks:
+        return
+    logger.info(f"⏳ Ожидаю фоновые задачи: {len(tasks)}")
+    _, unfinished = await asyncio.wait(tasks, timeout=max(timeout, 0))
+    for task in unfinished:
+        task.cancel()
+    if unfinished:
+        # Уведомления, платежи и доставки лежат на диске и будут повторены после перезапуска
+        logger.warning(f"⚠️ Фоновые задачи прерваны по таймауту: {len(unfinished)}")
+        await asyncio.wait(unfinished, timeout=1)
+
+def request_shutdown(application):
+    """Перестать принимать генерации и начать остановку бота"""
+    global ACCEPTING_GENERATIONS, DRAIN_TASK, SHUTDOWN_DEADLINE
+    if not ACCEPTING_GENERATIONS:
+        return
+    logger.info("🛑 Получен сигнал остановки, новые генерации не принимаются")
+    ACCEPTING_GENERATIONS = False
+    SHUTDOWN_DEADLINE = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+    # Дренаж идёт параллельно с application.stop(), который ждёт текущие обработчики:
+    # генерации, не успевшие к сроку, отменяются, и обработчики быстро завершаются
+    DRAIN_TASK = asyncio.create_task(drain_generations(SHUTDOWN_DRAIN_TIMEOUT))
+    application.stop_running()
+
+def save_pending_state():
+    """Сохранить на диск отложенные генерации и незаписанную аналитику"""
+    # Файл с заданиями прошлого запуска уже удалён, поэтому не начатые из них сохраняем снова
+    state = {"generations": PENDING_GENERATIONS + list(RESUME_QUEUE), "analytics": list(ANALYTICS_QUEUE)}
+    if not state["generations"] and not state["analytics"]:
+        return
+    temp_path = f"{PENDING_JOBS_PATH}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(temp_path, PENDING_JOBS_PATH)
+    logger.info(f"💾 Сохранено до перезапуска: генераций {len(state['generations'])}, записей аналитики {len(state['analytics'])}")
+
+def load_pending_state():
+    """Прочитать и удалить сохранённое при прошлой остановке состояние"""
+    if not os.path.exists(PENDING_JOBS_PATH):
+        return {}
+    try:
+        with open(PENDING_JOBS_PATH, encoding="utf-8") as f:
+            state = json.load(f)
+    except Exception as e:
+        logger.error(f"❌ Не удалось прочитать {PENDING_JOBS_PATH}: {e}")
+        state = {}
+    os.unlink(PENDING_JOBS_PATH)
+    return state
+
+async def resume_generation(bot, job):
+    """Выполнить генерацию, отложенную при прошлой остановке"""
+    user = SimpleNamespace(**job["user"])
+    params = job["params"]
+    success = False
+    try:
+        variants, _ = await run_tracked_generation(job["chat_id"], user, params)
+        locale = CATALOG.locale(params.get("locale"))
+        for variant_number, variant in enumerate(variants, start=1):
+            await send_to_chat(bot, job["chat_id"], f"**{locale.text('variant', number=variant_number)}:**\n\n{variant}", parse_mode="Markdown")
+        remember_variants(user.id, variants)
+        await send_to_chat(bot, job["chat_id"], locale.text("resume_hint"))
+        success = True
+    except GenerationDeferred:
+        # Бот снова останавливается: задание уже сохранено и выполнится после перезапуска
+        return
+    except Exception as e:
+        logger.error(f"❌ Ошибка при возобновлении генерации для {user.id}: {e}")
+    log_generation(
+        user=user,
+        category=params["main_category"],
+        subcategory=params["subcategory_key"],
+        style=params["style"],
+        emojis=params["emojis"],
+        name_provided=bool(params["name"]),
+        success=success
+    )
+
+async def resume_pending_generations(bot, jobs):
+    logger.info(f"▶️ Возобновляю отложенные генерации: {len(jobs)}")
+    RESUME_QUEUE.extend(jobs)
+    while RESUME_QUEUE and ACCEPTING_GENERATIONS:
+        await resume_generation(bot, RESUME_QUEUE.popleft())
+
+async def post_init(application: Application) -> None:
+    """Запуск фоновых задач и восстановление состояния после перезапуска"""
+    global METRICS_TASK
+    state = load_pending_state()
+    ANALYTICS_QUEUE.extend(state.get("analytics", []))
+    start_analytics_writer()
+    
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, request_shutdown, application)
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, reload_catalog)
+    
+    if state.get("generations"):
+        spawn(resume_pending_generations(application.bot, state["generations"]))
     
-    GOOGLE_SHEET, GOOGLE_SHEET_ID = init_google_sheets()
+    METRICS_TASK = asyncio.create_task(metrics_logger())
+    schedule_admin_notifications(application)
+    schedule_deliveries(application)
+    schedule_inline_index(application)
+    spawn(replay_payment_journal(application.bot))
     
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Тяжёлый модуль openai загружаем в фоне, пока бот уже отвечает на меню
+    spawn(asyncio.to_thread(importlib.import_module, "openai"))
+    logger.info(f"⏱ Импорт модулей: {IMPORTS_FINISHED - STARTUP_STARTED:.2f} с, инициализация: {time.perf_counter() - STARTUP_STARTED:.2f} с")
+
+FIRST_UPDATE_SEEN = False
+
+async def track_first_update(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Замер времени от запуска процесса до первого апдейта"""
+    global FIRST_UPDATE_SEEN
+    if not FIRST_UPDATE_SEEN:
+        FIRST_UPDATE_SEEN = True
+        logger.info(f"⏱ Первый апдейт через {time.perf_counter() - STARTUP_STARTED:.2f} с после запуска")
+
+async def post_stop(application: Application) -> None:
+    """Дренаж: обработчики уже завершены, бот ещё может отправлять сообщения"""
+    if DRAIN_TASK:
+        await DRAIN_TASK
+    if METRICS_TASK:
+        METRICS_TASK.cancel()
+    # Фоновые отправки ждём до того же срока, что и генерации; они же могут дописать аналитику
+    deadline = SHUTDOWN_DEADLINE or time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+    await drain_background_tasks(deadline - time.monotonic())
+    await flush_analytics(ANALYTICS_FLUSH_TIMEOUT)
+
+async def post_shutdown(application: Application) -> None:
+    """Сохранение отложенных заданий и закрытие локальных хранилищ"""
+    save_pending_state()
+    if GREETING_STORE is not None:
+        GREETING_STORE.close()
+    logger.info("✅ Бот остановлен")
+# --- КОНЕЦ: Жизненный цикл ---
+
+def build_application(builder=None):
+    """Приложение со всеми обработчиками; builder задаётся, чтобы подменить, например, транспорт запросов"""
+    application = (
+        (builder or Application.builder().token(TELEGRAM_TOKEN))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
             CATEGORY: [
-                CallbackQueryHandler(back_to_main_category, pattern="^back_to_main_category$"),
-                CallbackQueryHandler(restart_bot, pattern="^restart_bot$"),
-                CallbackQueryHandler(handle_donate_amount, pattern="^donate_(50|100|200|500)$"),
-                CallbackQueryHandler(choose_category),
+                CallbackQueryHandler(callback_router({
+                    CB_CATEGORY: choose_category,
+                    CB_DONATE: handle_donate_amount,
+                    CB_MAIN: back_to_main_category,
+                    CB_RESTART: restart_bot,
+                })),
             ],
             SUBCATEGORY: [
-                CallbackQueryHandler(back_to_main_category, pattern="^back_to_main_category$"),
-                CallbackQueryHandler(choose_subcategory),
+                CallbackQueryHandler(callback_router({
+                    CB_SUBCATEGORY: choose_subcategory,
+                    CB_MAIN: back_to_main_category,
+                })),
             ],
             STYLE: [
-                CallbackQueryHandler(back_to_category, pattern="^back_to_category$"),
-                CallbackQueryHandler(back_to_main_category, pattern="^back_to_main_category$"),
-                CallbackQueryHandler(choose_style),
+                CallbackQueryHandler(callback_router({
+                    CB_STYLE: choose_style,
+                    CB_BACK_CATEGORY: back_to_category,
+                    CB_MAIN: back_to_main_category,
+                })),
             ],
             EMOJIS: [
-                CallbackQueryHandler(back_to_style, pattern="^back_to_style$"),
-                CallbackQueryHandler(back_to_category, pattern="^back_to_category$"),
-                CallbackQueryHandler(back_to_main_category, pattern="^back_to_main_category$"),
-                CallbackQueryHandler(choose_emojis),
+                CallbackQueryHandler(callback_router({
+                    CB_EMOJIS: choose_emojis,
+                    CB_BACK_STYLE: back_to_style,
+                })),
             ],
             NAME: [
-                CallbackQueryHandler(skip_name, pattern="^skip_name$"),
-                CallbackQueryHandler(back_to_emojis, pattern="^back_to_emojis$"),
-                CallbackQueryHandler(back_to_style, pattern="^back_to_style$"),
-                CallbackQueryHandler(back_to_category, pattern="^back_to_category$"),
-                CallbackQueryHandler(back_to_main_category, pattern="^back_to_main_category$"),
+                CallbackQueryHandler(callback_router({
+                    CB_SKIP_NAME: skip_name,
+                    CB_BACK_EMOJIS: back_to_emojis,
+                })),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_name),
             ],
             GENERATE: [
-                CallbackQueryHandler(generate_again, pattern="^generate_again$"),
-                CallbackQueryHandler(restart_bot, pattern="^restart_bot$"),
-                CallbackQueryHandler(back_to_main_category, pattern="^back_to_main_category$"),
+                CallbackQueryHandler(callback_router({
+                    CB_MORE: generate_again,
+                    CB_SCHEDULE: schedule_variant,
+                    CB_RESTART: restart_bot,
+                    CB_MAIN: back_to_main_category,
+                })),
+            ],
+            SCHEDULE: [
+                CallbackQueryHandler(callback_router({
+                    CB_SCHEDULE: schedule_variant,
+                    CB_CANCEL: cancel_schedule,
+                    CB_MORE: generate_again,
+                    CB_RESTART: restart_bot,
+                })),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_schedule_date),
             ],
             FEEDBACK: [
-                CallbackQueryHandler(back_to_main_category, pattern="^back_to_main_category$"),
+                CallbackQueryHandler(callback_router({
+                    CB_MAIN: back_to_main_category,
+                })),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_feedback),
             ],
         },
         fallbacks=[CommandHandler('start', start)]
     )
 
+    application.add_handler(TypeHandler(Update, track_first_update), group=-1)
     application.add_handler(conv_handler)
+    # Кнопки из сообщений вне текущего диалога (например, после перезапуска бота)
+    application.add_handler(CallbackQueryHandler(reject_callback))
+    application.add_handler(CommandHandler('metrics', metrics_command))
+    application.add_handler(CommandHandler('reload_catalog', reload_catalog_command))
+    application.add_handler(InlineQueryHandler(inline_query_handler))
     application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
     application.add_error_handler(error_handler)
+    return application
+
+def main():
+    application = build_application()
 
     logger.info("🚀 Бот запущен и готов к работе!")
     logger.info(f"💰 Донаты через Telegram Stars: ВКЛЮЧЕНЫ")
-    logger.info(f"📊 Google Sheets: {'ВКЛЮЧЕНЫ' if GOOGLE_SHEET else 'ОТКЛЮЧЕНЫ'}")
+    logger.info(f"📊 Google Sheets: {'ВКЛЮЧЕНЫ (подключаются в фоне)' if ANALYTICS_ENABLED else 'ОТКЛЮЧЕНЫ'}")
     admin_id_status = os.getenv('ADMIN_TELEGRAM_ID', 'НЕ УСТАНОВЛЕН')
     logger.info(f"📧 Admin ID: {admin_id_status}")
     
     if admin_id_status == 'НЕ УСТАНОВЛЕН':
         logger.warning("⚠️ ВНИМАНИЕ: ADMIN_TELEGRAM_ID не установлен! Обратная связь не будет отправляться.")
     
-    application.run_polling()
+    # Сигналы остановки обрабатываются в request_shutdown, чтобы успеть завершить генерации
+    application.run_polling(stop_signals=None)
 
 if __name__ == '__main__':
     main()